@@ -1,19 +1,39 @@
+import time
+PROCESS_START = time.perf_counter()
+
 import os
 import asyncio
 import logging
-from datetime import datetime, timedelta
-from telethon import TelegramClient, events
-from pytgcalls import PyTgCalls, StreamType
-from pytgcalls.types.input_stream import AudioPiped, VideoPiped, AudioVideoPiped
-from pytgcalls.types.input_stream.quality import HighQualityAudio, HighQualityVideo
-from pytgcalls.exceptions import NoActiveGroupCall
-import yt_dlp
+import logging.handlers
+from datetime import datetime
+from telethon import TelegramClient, events, Button
+from telethon.errors import MessageNotModifiedError
 import sqlite3
 import json
 from typing import Dict, List
-import aiohttp
-import aiofiles
 from pathlib import Path
+from collections import Counter, deque
+from contextvars import ContextVar
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from functools import partial, wraps
+from urllib.parse import urlparse
+from urllib.request import url2pathname
+import hashlib
+import heapq
+import http.client
+import importlib
+import inspect
+import itertools
+import queue
+import random
+import re
+import shutil
+import signal
+import sys
+import threading
+import traceback
+import tracemalloc
 
 # Configure logging
 logging.basicConfig(
@@ -22,6 +42,1314 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+class MediaRejected(Exception):
+    """Resolved media failed the admission limits; the message is shown to the user"""
+
+class SourceUnavailable(MediaRejected):
+    """The source's circuit breaker is open and there was no fallback to try"""
+
+# Heavy dependencies (pytgcalls, yt_dlp, aiohttp, aiofiles) are imported on
+# first use so startup only pays for what it needs before going online.
+
+def format_frame_stack(frame, limit=12):
+    """Format a frame's call stack, innermost call last"""
+    return ''.join(traceback.format_list(traceback.extract_stack(frame, limit=limit)))
+
+def parse_timestamp(text):
+    """Parse '90', '1:30' or '1:02:30' into seconds, or None if invalid"""
+    try:
+        parts = [int(part) for part in text.strip().split(':')]
+    except ValueError:
+        return None
+    if not 1 <= len(parts) <= 3 or any(part < 0 for part in parts):
+        return None
+    seconds = 0
+    for part in parts:
+        seconds = seconds * 60 + part
+    return seconds
+
+def format_timestamp(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+
+class LoopLagWatchdog:
+    """Detect event loop stalls and capture the code that is blocking it"""
+
+    def __init__(self, threshold=0.25, interval=0.1, max_reports=20):
+        self.threshold = threshold
+        self.interval = interval
+        self.max_reports = max_reports
+        self.max_lag = 0.0
+        self.stall_count = 0
+        self.blockers = Counter()  # stack: times seen
+        self._last_beat = time.monotonic()
+        self._loop_thread_id = None
+        self._stopped = threading.Event()
+
+    async def run(self):
+        """Heartbeat coroutine measuring how late the loop wakes us up"""
+        loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        threading.Thread(target=self._monitor, name='loop-watchdog', daemon=True).start()
+
+        try:
+            while True:
+                expected = loop.time() + self.interval
+                await asyncio.sleep(self.interval)
+                lag = loop.time() - expected
+                self._last_beat = time.monotonic()
+                self.max_lag = max(self.max_lag, lag)
+        finally:
+            self._stopped.set()
+
+    def _monitor(self):
+        """Watchdog thread sampling the loop thread's stack while it is stalled"""
+        captured_beat = None
+        while not self._stopped.wait(self.interval / 2):
+            beat = self._last_beat
+            stalled_for = time.monotonic() - beat - self.interval
+            if stalled_for < self.threshold or beat == captured_beat:
+                continue
+
+            # One capture per stall: the loop thread is still inside the blocking call
+            captured_beat = beat
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+
+            stack = format_frame_stack(frame)
+            self.stall_count += 1
+            self.blockers[stack] += 1
+            if self.blockers[stack] <= self.max_reports:
+                logger.warning(f"Event loop blocked for {stalled_for * 1000:.0f}ms in:\n{stack}")
+
+    def top_blockers(self, n=5):
+        """Most frequently captured blocking stacks"""
+        return self.blockers.most_common(n)
+
+class SamplingProfiler:
+    """Low-overhead statistical profiler sampling every thread's stack"""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = 0
+        self.stacks = Counter()  # collapsed stack: samples
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._sample, name='sampling-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def _sample(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                names = []
+                while frame is not None:
+                    code = frame.f_code
+                    names.append(f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                self.stacks[';'.join(reversed(names))] += 1
+            self.samples += 1
+
+    def hot_functions(self, n=10):
+        """Functions with the most samples as the innermost frame"""
+        leaf_counts = Counter()
+        for stack, count in self.stacks.items():
+            leaf_counts[stack.rsplit(';', 1)[-1]] += count
+        return leaf_counts.most_common(n)
+
+    def collapsed(self):
+        """Stacks in collapsed format, as consumed by flamegraph tools"""
+        return '\n'.join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+
+class Tracer:
+    """Sampled per-command traces, written as Chrome trace events (one JSON object per line)"""
+
+    def __init__(self):
+        self.sample_rate = 0.0
+        self.path = None
+        self.recent = deque(maxlen=50)  # (trace_id, command, started, duration ms)
+        self._current = ContextVar('trace', default=None)  # (trace_id, lane, parent span name)
+        self._log = logging.getLogger(f"{__name__}.trace")
+        self._log.propagate = False
+
+    def configure(self, path, sample_rate, max_bytes, backups=3):
+        """Write spans to a rotating file from a background thread"""
+        self.sample_rate = sample_rate
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        handler = logging.handlers.RotatingFileHandler(self.path, maxBytes=max_bytes, backupCount=backups)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        records = queue.SimpleQueue()
+        self._log.addHandler(logging.handlers.QueueHandler(records))
+        self._log.setLevel(logging.INFO)
+        logging.handlers.QueueListener(records, handler).start()
+
+    @property
+    def trace_id(self):
+        current = self._current.get()
+        return current[0] if current else None
+
+    @contextmanager
+    def trace(self, command, **args):
+        """Start a trace for one command, if it is sampled"""
+        if self._current.get() or not self.sample_rate or random.random() >= self.sample_rate:
+            yield
+            return
+        
+        trace_id = os.urandom(8).hex()
+        token = self._current.set((trace_id, int(trace_id[:6], 16), None))
+        started = datetime.now()
+        try:
+            with self.span(command, **args) as span:
+                yield
+        finally:
+            self._current.reset(token)
+            self.recent.append((trace_id, command, started, span['dur'] / 1000))
+
+    @contextmanager
+    def span(self, name, **args):
+        """Time a block as a span of the current trace; a no-op outside traces"""
+        current = self._current.get()
+        if current is None:
+            yield {'dur': 0}
+            return
+        
+        trace_id, lane, parent = current
+        event = {'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': lane, 'ts': int(time.time() * 1e6),
+                 'args': {'trace_id': trace_id, 'parent': parent, **args}}
+        token = self._current.set((trace_id, lane, name))
+        started = time.perf_counter()
+        try:
+            yield event
+        except BaseException as e:
+            event['args']['error'] = repr(e)[:200]
+            raise
+        finally:
+            event['dur'] = int((time.perf_counter() - started) * 1e6)
+            self._current.reset(token)
+            self._log.info(json.dumps(event, default=str))
+
+    def traced(self, name):
+        """Decorator wrapping a function or coroutine function in a span"""
+        def decorator(func):
+            if inspect.iscoroutinefunction(func):
+                @wraps(func)
+                async def wrapper(*args, **kwargs):
+                    with self.span(name):
+                        return await func(*args, **kwargs)
+            else:
+                @wraps(func)
+                def wrapper(*args, **kwargs):
+                    with self.span(name):
+                        return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def capture(self):
+        return self._current.get()
+
+    @contextmanager
+    def resume(self, captured):
+        """Continue a captured trace in another task"""
+        token = self._current.set(captured)
+        try:
+            yield
+        finally:
+            self._current.reset(token)
+
+    def load(self, trace_id):
+        """Blocking: all events of one trace from the current and rotated files"""
+        needle = f'"trace_id": "{trace_id}"'
+        events = []
+        for path in sorted(self.path.parent.glob(f"{self.path.name}*")):
+            with open(path) as lines:
+                events.extend(json.loads(line) for line in lines if needle in line)
+        return sorted(events, key=lambda event: event['ts'])
+
+tracer = Tracer()
+
+
+def traced_command(method):
+    """Give each run of a command handler its own (sampled) trace"""
+    @wraps(method)
+    async def wrapper(self, event, *args, **kwargs):
+        with tracer.trace(method.__name__.replace('handle_', '/'), chat_id=event.chat_id, user_id=getattr(event, 'sender_id', None)):
+            return await method(self, event, *args, **kwargs)
+    return wrapper
+
+# Download priorities, lowest value runs first
+PRIORITY_PLAYBACK = 0  # feeds the current or next-up track
+PRIORITY_PREMIUM = 1
+PRIORITY_FREE = 2
+PRIORITY_PREFETCH = 3  # speculative work, yields bandwidth to everything else
+
+class BandwidthLimiter:
+    """Token bucket shared by every download thread"""
+
+    def __init__(self, rate):
+        self.rate = rate  # bytes per second, 0 disables shaping
+        self._tokens = rate
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, nbytes):
+        """Take nbytes from the bucket and return how long the caller must wait"""
+        if not self.rate:
+            return 0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.rate, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= nbytes
+            return max(0, -self._tokens / self.rate)
+
+    def consume(self, nbytes):
+        time.sleep(self.reserve(nbytes))
+
+    async def consume_async(self, nbytes):
+        await asyncio.sleep(self.reserve(nbytes))
+
+class DownloadJob:
+    def __init__(self, priority):
+        self.priority = priority
+        self.downloaded_bytes = 0
+
+class DownloadScheduler:
+    """Priority queue in front of the download threads"""
+
+    def __init__(self, max_concurrent=3, bandwidth_limit=0):
+        self.max_concurrent = max_concurrent
+        self.limiter = BandwidthLimiter(bandwidth_limit)
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrent, thread_name_prefix='download')
+        self.active = Counter()  # priority: running jobs
+        self._waiting = []  # heap of (priority, seq, future)
+        self._seq = itertools.count()
+        self._local = threading.local()
+
+    @property
+    def pending(self):
+        return sum(1 for _, _, future in self._waiting if not future.done())
+
+    @asynccontextmanager
+    async def slot(self, priority):
+        """Hold one of the global download slots"""
+        await self._acquire(priority)
+        try:
+            yield
+        finally:
+            self._release(priority)
+
+    async def run_in_thread(self, priority, func, *args):
+        """Run a blocking download function on a download thread, inside a held slot"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self._run_job, DownloadJob(priority), func, args)
+
+    def _run_job(self, job, func, args):
+        self._local.job = job
+        try:
+            return func(*args)
+        finally:
+            self._local.job = None
+
+    async def _acquire(self, priority):
+        if sum(self.active.values()) < self.max_concurrent and not self.pending:
+            self.active[priority] += 1
+            return
+        
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiting, (priority, next(self._seq), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # The slot may have been handed over just as we were cancelled
+            if future.done() and not future.cancelled():
+                self._release(priority)
+            raise
+
+    def _release(self, priority):
+        self.active[priority] -= 1
+        while self._waiting:
+            next_priority, _, future = heapq.heappop(self._waiting)
+            if not future.done():
+                self.active[next_priority] += 1
+                future.set_result(None)
+                break
+
+    def higher_priority_active(self, priority):
+        return any(count for p, count in self.active.items() if p < priority)
+
+    def progress_hook(self, status):
+        """yt-dlp progress hook shaping bandwidth from the download thread"""
+        job = getattr(self._local, 'job', None)
+        if job is None or status.get('status') != 'downloading':
+            return
+        
+        downloaded = status.get('downloaded_bytes') or 0
+        delta = max(0, downloaded - job.downloaded_bytes)
+        job.downloaded_bytes = downloaded
+        
+        # Speculative work pauses while anything more urgent is downloading
+        if job.priority >= PRIORITY_PREFETCH:
+            while self.higher_priority_active(job.priority):
+                time.sleep(0.2)
+        self.limiter.consume(delta)
+
+    async def throttle(self, priority, nbytes):
+        """Async counterpart of progress_hook for native downloads"""
+        if priority >= PRIORITY_PREFETCH:
+            while self.higher_priority_active(priority):
+                await asyncio.sleep(0.2)
+        await self.limiter.consume_async(nbytes)
+
+class RangedDownloader:
+    """Parallel HTTP range downloader for direct media URLs"""
+
+    def __init__(self, segments=4, min_segment_size=4 * 1024 * 1024, retries=5, chunk_size=256 * 1024):
+        self.segments = segments
+        self.min_segment_size = min_segment_size
+        self.retries = retries
+        self.chunk_size = chunk_size
+        self._session = None
+
+    @property
+    def session(self):
+        """Connection pool shared by every download"""
+        import aiohttp
+        
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=32, ttl_dns_cache=300),
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=15, sock_read=30)
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+    async def probe(self, url, headers):
+        """Return (size, supports_ranges) using a one-byte range request"""
+        async with self.session.get(url, headers={**headers, 'Range': 'bytes=0-0'}) as resp:
+            resp.raise_for_status()
+            content_range = resp.headers.get('Content-Range', '')
+            if resp.status == 206 and '/' in content_range:
+                total = content_range.rsplit('/', 1)[1]
+                if total.isdigit():
+                    return int(total), True
+            return resp.content_length, False
+
+    async def download(self, url, dest, headers=None, throttle=None, max_bytes=None):
+        """Download url to dest, resuming a previous partial download if one exists"""
+        import aiofiles
+        
+        headers = dict(headers or {})
+        size, supports_ranges = await self.probe(url, headers)
+        part_path = Path(f"{dest}.part")
+        state_path = Path(f"{dest}.part.json")
+        if max_bytes and size and size > max_bytes:
+            raise MediaRejected(f"Too large: {size // (1024 * 1024)} MB (limit {max_bytes // (1024 * 1024)} MB)")
+        
+        if not supports_ranges or not size:
+            try:
+                await self._fetch_stream(url, headers, part_path, throttle, max_bytes)
+            except BaseException:
+                part_path.unlink(missing_ok=True)
+                raise
+            part_path.replace(dest)
+            return dest
+        
+        segments = await asyncio.to_thread(self._load_state, state_path, part_path, url, size)
+        if segments is None:
+            segments = self._plan_segments(size)
+            async with aiofiles.open(part_path, 'wb') as f:
+                await f.truncate(size)
+        
+        try:
+            await asyncio.gather(*(
+                self._fetch_range(url, headers, part_path, segment, throttle)
+                for segment in segments
+            ))
+        except BaseException:
+            # Keep progress so the next attempt resumes instead of starting over
+            await asyncio.to_thread(self._save_state, state_path, url, size, segments)
+            raise
+        
+        part_path.replace(dest)
+        state_path.unlink(missing_ok=True)
+        return dest
+
+    def _plan_segments(self, size):
+        count = max(1, min(self.segments, size // self.min_segment_size))
+        step = -(-size // count)
+        return [
+            {'start': start, 'end': min(start + step, size) - 1, 'done': 0}
+            for start in range(0, size, step)
+        ]
+
+    def _load_state(self, state_path, part_path, url, size):
+        try:
+            with open(state_path) as f:
+                state = json.load(f)
+            part_size = part_path.stat().st_size
+        except (OSError, ValueError):
+            return None  # also when the preallocated part file is gone
+        if state.get('url') != url or state.get('size') != size or part_size != size:
+            return None
+        return state['segments']
+
+    def _save_state(self, state_path, url, size, segments):
+        with open(state_path, 'w') as f:
+            json.dump({'url': url, 'size': size, 'segments': segments}, f)
+
+    async def _fetch_range(self, url, headers, part_path, segment, throttle):
+        import aiohttp
+        import aiofiles
+        
+        for attempt in range(self.retries + 1):
+            start = segment['start'] + segment['done']
+            if start > segment['end']:
+                return
+            try:
+                range_headers = {**headers, 'Range': f"bytes={start}-{segment['end']}"}
+                async with self.session.get(url, headers=range_headers) as resp:
+                    if resp.status != 206:
+                        raise aiohttp.ClientResponseError(
+                            resp.request_info, resp.history, status=resp.status,
+                            message="Server ignored range request"
+                        )
+                    async with aiofiles.open(part_path, 'r+b') as f:
+                        await f.seek(start)
+                        async for chunk in resp.content.iter_chunked(self.chunk_size):
+                            if throttle:
+                                await throttle(len(chunk))
+                            await f.write(chunk)
+                            segment['done'] += len(chunk)
+                return
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt == self.retries:
+                    raise
+                logger.warning(f"Range {start}-{segment['end']} failed ({e}), retrying")
+                await asyncio.sleep(min(2 ** attempt, 30))
+
+    async def _fetch_stream(self, url, headers, part_path, throttle, max_bytes=None):
+        """Single-stream fallback for servers without range support"""
+        import aiofiles
+        
+        written = 0
+        async with self.session.get(url, headers=headers) as resp:
+            resp.raise_for_status()
+            async with aiofiles.open(part_path, 'wb') as f:
+                async for chunk in resp.content.iter_chunked(self.chunk_size):
+                    written += len(chunk)
+                    # Without a length up front this is the only guard against endless streams
+                    if max_bytes and written > max_bytes:
+                        raise MediaRejected(f"Too large: passed the {max_bytes // (1024 * 1024)} MB limit while downloading")
+                    if throttle:
+                        await throttle(len(chunk))
+                    await f.write(chunk)
+
+class ExtractorPool:
+    """Reusable, pre-initialized YoutubeDL instances, one pool per option set"""
+
+    def __init__(self, size=3):
+        self.size = size
+        self.created = 0
+        self._pools = {}  # kind: idle instances
+        self._lock = threading.Lock()
+
+    def _create(self, opts):
+        import yt_dlp
+        
+        ytdl = yt_dlp.YoutubeDL(opts)
+        ytdl.get_info_extractor('Youtube')  # load the common extractor up front
+        with self._lock:
+            self.created += 1
+        return ytdl
+
+    def _pool(self, kind):
+        with self._lock:
+            return self._pools.setdefault(kind, queue.SimpleQueue())
+
+    def warm(self, opts_by_kind):
+        """Blocking: fill every pool ahead of the first request"""
+        for kind, opts in opts_by_kind.items():
+            pool = self._pool(kind)
+            while pool.qsize() < self.size:
+                pool.put(self._create(opts))
+
+    @contextmanager
+    def acquire(self, kind, opts):
+        """Borrow an instance for one thread, creating one if the pool is empty"""
+        pool = self._pool(kind)
+        try:
+            ytdl = pool.get_nowait()
+        except queue.Empty:
+            ytdl = self._create(opts)
+        try:
+            yield ytdl
+        finally:
+            if pool.qsize() < self.size:
+                pool.put(ytdl)
+            else:
+                ytdl.close()
+
+SEARCH_SOURCES = {'ytsearch': 'youtube', 'scsearch': 'soundcloud'}  # yt-dlp search prefix: source
+
+
+class CircuitBreaker:
+    """Fails fast on a source after repeated errors, letting one probe through after a cool-down"""
+
+    def __init__(self, name, failure_threshold=3, reset_timeout=60):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0  # consecutive
+        self.opened_at = 0.0
+        self.probing = False
+        self.last_error = None
+        self.stats = Counter()
+
+    @property
+    def retry_in(self):
+        if self.state == 'closed':
+            return 0
+        return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+    def allow(self):
+        """Whether a request may go to the source now"""
+        if self.state == 'open' and not self.retry_in:
+            self.state = 'half_open'
+        if self.state == 'closed':
+            return True
+        if self.state == 'half_open' and not self.probing:
+            self.probing = True  # single trial request
+            return True
+        self.stats['fast_failed'] += 1
+        return False
+
+    def record_success(self):
+        if self.state != 'closed':
+            logger.info(f"Source {self.name} recovered")
+        self.state = 'closed'
+        self.failures = 0
+        self.probing = False
+        self.stats['succeeded'] += 1
+
+    def record_failure(self, error):
+        self.failures += 1
+        self.probing = False
+        self.last_error = str(error)[:200]
+        self.stats['failed'] += 1
+        if self.state == 'half_open' or self.failures >= self.failure_threshold:
+            if self.state != 'open':
+                logger.warning(f"Source {self.name} unavailable after {self.failures} failure(s): {self.last_error}")
+                self.stats['opened'] += 1
+            self.state = 'open'
+            self.opened_at = time.monotonic()
+
+AUDIO_EXTENSIONS = ('.mp3', '.flac', '.m4a', '.ogg', '.opus', '.wav', '.aac', '.wma')
+
+class MusicLibrary:
+    """Incrementally indexed local music directories with SQLite FTS5 search"""
+
+    def __init__(self, conn, roots, probe_concurrency=4, batch_size=100):
+        self.conn = conn
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.batch_size = batch_size
+        self.dir_mtimes = {}  # directory: mtime when last indexed, None while its files are being stored
+        self.probe_semaphore = asyncio.Semaphore(probe_concurrency)
+        self.enabled = bool(self.roots) and self._init_schema()
+
+    def _init_schema(self):
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS library_files (
+                    path TEXT PRIMARY KEY,
+                    directory TEXT,
+                    mtime REAL,
+                    size INTEGER,
+                    title TEXT,
+                    artist TEXT,
+                    album TEXT,
+                    duration INTEGER
+                )
+            ''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_library_directory ON library_files (directory)')
+            cursor.execute('''
+                CREATE VIRTUAL TABLE IF NOT EXISTS library_fts USING fts5(
+                    title, artist, album, content='library_files', content_rowid='rowid'
+                )
+            ''')
+            
+            # Keep the FTS index in sync with library_files
+            cursor.executescript('''
+                CREATE TRIGGER IF NOT EXISTS library_files_ai AFTER INSERT ON library_files BEGIN
+                    INSERT INTO library_fts (rowid, title, artist, album)
+                    VALUES (new.rowid, new.title, new.artist, new.album);
+                END;
+                CREATE TRIGGER IF NOT EXISTS library_files_ad AFTER DELETE ON library_files BEGIN
+                    INSERT INTO library_fts (library_fts, rowid, title, artist, album)
+                    VALUES ('delete', old.rowid, old.title, old.artist, old.album);
+                END;
+                CREATE TRIGGER IF NOT EXISTS library_files_au AFTER UPDATE ON library_files BEGIN
+                    INSERT INTO library_fts (library_fts, rowid, title, artist, album)
+                    VALUES ('delete', old.rowid, old.title, old.artist, old.album);
+                    INSERT INTO library_fts (rowid, title, artist, album)
+                    VALUES (new.rowid, new.title, new.artist, new.album);
+                END;
+            ''')
+            self.conn.commit()
+        except sqlite3.OperationalError as e:
+            logger.warning(f"Local library disabled, SQLite FTS5 unavailable: {e}")
+            return False
+        return True
+
+    async def watch(self, interval=30, full_scan_every=86400):
+        """Background task: full scan at startup, then re-list only changed directories"""
+        last_full_scan = 0
+        while True:
+            try:
+                full = time.monotonic() - last_full_scan >= full_scan_every
+                await self.scan(full=full)
+                if full:
+                    last_full_scan = time.monotonic()
+            except Exception as e:
+                logger.error(f"Library scan error: {e}")
+            
+            await asyncio.sleep(interval)
+
+    async def scan(self, full=False):
+        """Index new and modified files; a full scan also re-checks unchanged directories"""
+        started = time.perf_counter()
+        if full:
+            directories = self.roots
+        else:
+            directories = await asyncio.to_thread(self._changed_directories)
+            if not directories:
+                return
+        
+        listed, gone = await asyncio.to_thread(self._list_directories, directories, full)
+        cursor = self.conn.cursor()
+        changed_files = []
+        
+        unstored = Counter()  # directory: changed files not stored yet
+        for directory, (dir_mtime, files) in listed.items():
+            cursor.execute('SELECT path, mtime, size FROM library_files WHERE directory = ?', (directory,))
+            known = {path: (mtime, size) for path, mtime, size in cursor.fetchall()}
+            
+            removed = [(path,) for path in known if path not in files]
+            cursor.executemany('DELETE FROM library_files WHERE path = ?', removed)
+            changed = [(path, directory, stat) for path, stat in files.items() if known.get(path) != stat]
+            changed_files.extend(changed)
+            unstored[directory] = len(changed)
+            # Until its files are stored the directory stays "changed", so a failed scan is retried
+            self.dir_mtimes[directory] = None if changed else dir_mtime
+        
+        for directory in gone:
+            cursor.execute(
+                'DELETE FROM library_files WHERE directory = ? OR directory LIKE ?',
+                (directory, directory + os.sep + '%')
+            )
+            for known_directory in list(self.dir_mtimes):
+                if known_directory == directory or known_directory.startswith(directory + os.sep):
+                    del self.dir_mtimes[known_directory]
+        self.conn.commit()
+        
+        # Stored in batches: files become searchable as the scan goes and a restart keeps the progress
+        for start in range(0, len(changed_files), self.batch_size):
+            batch = changed_files[start:start + self.batch_size]
+            tags = await asyncio.gather(*(self._probe(path) for path, _, _ in batch))
+            cursor.executemany('''
+                INSERT INTO library_files (path, directory, mtime, size, title, artist, album, duration)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (path) DO UPDATE SET
+                    mtime = excluded.mtime, size = excluded.size, title = excluded.title,
+                    artist = excluded.artist, album = excluded.album, duration = excluded.duration
+            ''', [
+                (path, directory, mtime, size, *tag)
+                for (path, directory, (mtime, size)), tag in zip(batch, tags)
+            ])
+            self.conn.commit()
+            
+            for _, directory, _ in batch:
+                unstored[directory] -= 1
+                if not unstored[directory] and directory in self.dir_mtimes:
+                    self.dir_mtimes[directory] = listed[directory][0]
+        
+        if changed_files or gone or full:
+            logger.info(
+                f"Library {'full' if full else 'incremental'} scan: {len(listed)} dirs listed, "
+                f"{len(changed_files)} files indexed in {time.perf_counter() - started:.2f}s"
+            )
+
+    def _changed_directories(self):
+        """Blocking: known directories whose mtime moved since they were listed"""
+        changed = []
+        for directory, mtime in list(self.dir_mtimes.items()):
+            try:
+                if os.stat(directory).st_mtime != mtime:
+                    changed.append(directory)
+            except FileNotFoundError:
+                changed.append(directory)
+        return changed
+
+    def _list_directories(self, directories, full):
+        """Blocking: list directories, descending into subdirectories not seen before"""
+        listed, gone = {}, []
+        stack = list(directories)
+        while stack:
+            directory = stack.pop()
+            files = {}
+            try:
+                dir_mtime = os.stat(directory).st_mtime
+                with os.scandir(directory) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            if full or entry.path not in self.dir_mtimes:
+                                stack.append(entry.path)
+                        elif entry.name.lower().endswith(AUDIO_EXTENSIONS):
+                            stat = entry.stat()
+                            files[entry.path] = (stat.st_mtime, stat.st_size)
+            except FileNotFoundError:
+                gone.append(directory)
+                continue
+            listed[directory] = (dir_mtime, files)
+        return listed, gone
+
+    async def _probe(self, path):
+        """Read (title, artist, album, duration) tags with ffprobe"""
+        async with self.probe_semaphore:
+            process = await asyncio.create_subprocess_exec(
+                'ffprobe', '-v', 'quiet', '-print_format', 'json', '-show_format', path,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.DEVNULL
+            )
+            stdout, _ = await process.communicate()
+        
+        try:
+            fmt = json.loads(stdout or b'{}').get('format', {})
+        except ValueError:
+            fmt = {}
+        tags = {key.lower(): value for key, value in fmt.get('tags', {}).items()}
+        return (
+            tags.get('title') or Path(path).stem,
+            tags.get('artist') or tags.get('album_artist') or '',
+            tags.get('album') or '',
+            int(float(fmt.get('duration') or 0))
+        )
+
+    def contains(self, path):
+        """Whether path resolves to somewhere under one of the library roots"""
+        resolved = Path(path).resolve()
+        return any(resolved.is_relative_to(Path(root).resolve()) for root in self.roots)
+
+    def search(self, query, limit=1):
+        """Best matching indexed files for a free-text query"""
+        if not self.enabled:
+            return []
+        tokens = re.findall(r'\w+', query.lower())
+        if not tokens:
+            return []
+        
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT f.path, f.title, f.artist, f.album, f.duration
+            FROM library_fts JOIN library_files f ON f.rowid = library_fts.rowid
+            WHERE library_fts MATCH ?
+            ORDER BY bm25(library_fts)
+            LIMIT ?
+        ''', (' '.join(f'"{token}"' for token in tokens), limit))
+        
+        keys = ('path', 'title', 'artist', 'album', 'duration')
+        return [dict(zip(keys, row)) for row in cursor.fetchall() if os.path.exists(row[0])]
+
+# ffmpeg input options for endless network sources: reconnect on drops and
+# keep probing small so buffering stays bounded
+LIVE_FFMPEG_PARAMETERS = (
+    '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 10 '
+    '-rw_timeout 15000000 -probesize 65536 -analyzeduration 1000000'
+)
+
+# Audio variants derived locally from the single best-quality source
+AUDIO_VARIANTS = {
+    'premium': None,  # the source itself
+    'free': ['-vn', '-c:a', 'libopus', '-b:a', '128k'],
+}
+
+# Effect renders: name -> (label, ffmpeg audio filter, playback speed factor)
+AUDIO_EFFECTS = {
+    'bass': ('Bass Boost', 'bass=g=8:f=110,alimiter=limit=0.95', 1.0),
+    'nightcore': ('Nightcore', 'aresample=48000,asetrate=60000,aresample=48000', 1.25),
+    'vaporwave': ('Vaporwave', 'aresample=48000,asetrate=38400,aresample=48000', 0.8),
+    'speed': ('Speed 1.25x', 'atempo=1.25', 1.25),
+    'slow': ('Slowed 0.8x', 'atempo=0.8', 0.8),
+}
+
+class TieredMediaStore:
+    """Memory-backed hot tier for playing media in front of the on-disk cold tier"""
+
+    def __init__(self, cold_dir, hot_dir=None, hot_budget=0, cold_budget=0, workers=2):
+        self.cold_dir = Path(cold_dir)
+        self.hot_dir = Path(hot_dir) if hot_dir and hot_budget else None
+        self.hot_budget = hot_budget
+        self.cold_budget = cold_budget
+        self.workers = workers
+        self.pins = {}  # chat_id: {cold paths}
+        self.last_access = {}  # cold path: timestamp
+        self.stats = Counter()  # hot_hits, cold_hits, misses, promoted, demoted, evicted
+        self._promotions = asyncio.Queue()
+        
+        if self.hot_dir:
+            self.hot_dir.mkdir(parents=True, exist_ok=True)
+            # tmpfs mounts are often smaller than the budget; Docker's default /dev/shm is 64 MB
+            capacity = int(shutil.disk_usage(self.hot_dir).total * 0.9)
+            if capacity < self.hot_budget:
+                logger.warning(f"Hot tier capped at {capacity // (1024 * 1024)} MB to fit {self.hot_dir}")
+                self.hot_budget = capacity
+            for stale in self.hot_dir.glob('.*.tmp'):
+                stale.unlink(missing_ok=True)  # copies interrupted by a previous process
+
+    def start(self):
+        """Start the background promotion workers"""
+        for _ in range(self.workers if self.hot_dir else 0):
+            asyncio.create_task(self._promotion_worker())
+
+    def hot_path(self, path):
+        return self.hot_dir / Path(path).name
+
+    @property
+    def pinned(self):
+        return set().union(*self.pins.values())
+
+    def resolve(self, path):
+        """Return the fastest available copy of a cached file"""
+        path = str(path)
+        self.last_access[path] = time.time()
+        
+        if self.hot_dir and self.hot_path(path).exists():
+            self.stats['hot_hits'] += 1
+            return str(self.hot_path(path))
+        if os.path.exists(path):
+            self.stats['cold_hits'] += 1
+        else:
+            self.stats['misses'] += 1
+        return path
+
+    def pin(self, chat_id, paths):
+        """Pin a chat's current and next-up files and promote them to the hot tier"""
+        paths = {str(path) for path in paths if path}
+        self.pins[chat_id] = paths
+        for path in paths:
+            self.last_access[path] = time.time()
+            # Only cache entries are promoted; other local files keep their own paths
+            if self.hot_dir and Path(path).parent == self.cold_dir and not self.hot_path(path).exists():
+                self._promotions.put_nowait(path)
+
+    def unpin(self, chat_id):
+        return self.pins.pop(chat_id, set())
+
+    async def settle(self):
+        """Wait until every queued promotion has been copied to the hot tier"""
+        await self._promotions.join()
+
+    async def _promotion_worker(self):
+        while True:
+            path = await self._promotions.get()
+            try:
+                if os.path.exists(path) and not self.hot_path(path).exists():
+                    if await asyncio.to_thread(self._promote, path):
+                        self.stats['promoted'] += 1
+                await asyncio.to_thread(self._enforce_hot_budget)
+            except Exception as e:
+                logger.error(f"Hot tier promotion error: {e}")
+            finally:
+                self._promotions.task_done()
+
+    def _promote(self, path):
+        """Copy a cold file to the hot tier, making room first; False if it can't fit"""
+        size = os.path.getsize(path)
+        if size > self.hot_budget:
+            return False
+        used = self._evict(self.hot_dir, self.hot_budget - size, 'hot', 'demoted')
+        if used + size > self.hot_budget or shutil.disk_usage(self.hot_dir).free < size:
+            return False  # the rest is pinned, or the mount is shared and full
+        
+        hot_path = self.hot_path(path)
+        tmp_path = hot_path.with_name(f".{hot_path.name}.tmp")
+        try:
+            shutil.copyfile(path, tmp_path)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+        tmp_path.replace(hot_path)
+        return True
+
+    def _entries(self, directory):
+        """(path, size, last access) for cached files, least recently used first"""
+        entries = []
+        with os.scandir(directory) as it:
+            for entry in it:
+                if not entry.is_file() or entry.name.startswith('.'):
+                    continue
+                stat = entry.stat()
+                cold_path = str(self.cold_dir / entry.name)
+                last_used = max(stat.st_mtime, self.last_access.get(cold_path, 0))
+                entries.append((entry.path, cold_path, stat.st_size, last_used))
+        entries.sort(key=lambda entry: entry[3])
+        return entries
+
+    def _evict(self, directory, budget, tier, stat_name, min_idle=0):
+        entries = self._entries(directory)
+        total = sum(entry[2] for entry in entries)
+        pinned = self.pinned
+        now = time.time()
+        
+        for path, cold_path, size, last_used in entries:
+            if total <= budget:
+                break
+            # Never drop files being played, queued next or still being written
+            if cold_path in pinned or now - last_used < min_idle:
+                continue
+            Path(path).unlink(missing_ok=True)
+            total -= size
+            self.stats[stat_name] += 1
+            logger.info(f"Evicted {path} from {tier} tier")
+        return total
+
+    def _enforce_hot_budget(self):
+        self._evict(self.hot_dir, self.hot_budget, 'hot', 'demoted')
+
+    def enforce_cold_budget(self):
+        """Blocking: drop least recently used cold files until under budget"""
+        self._evict(self.cold_dir, self.cold_budget, 'cold', 'evicted', min_idle=600)
+        for cold_path in list(self.last_access):
+            if not os.path.exists(cold_path):
+                del self.last_access[cold_path]
+
+    def hit_rates(self):
+        lookups = self.stats['hot_hits'] + self.stats['cold_hits'] + self.stats['misses']
+        if not lookups:
+            return 0.0, 0.0
+        return self.stats['hot_hits'] / lookups, self.stats['cold_hits'] / lookups
+
+CARD_TEMPLATE = 'nowplaying-v1'  # bump when the card layout changes
+CARD_SIZE = (1280, 720)
+
+
+def load_card_font(size, bold=False):
+    from PIL import ImageFont
+    
+    try:
+        return ImageFont.truetype(os.getenv('CARD_FONT') or ('DejaVuSans-Bold.ttf' if bold else 'DejaVuSans.ttf'), size)
+    except OSError:
+        return ImageFont.load_default()
+
+
+def wrap_card_text(draw, text, font, width, max_lines):
+    """Greedy word wrap by rendered width, ellipsizing the last line"""
+    lines, line = [], ''
+    for word in text.split():
+        candidate = f"{line} {word}".strip()
+        if line and draw.textlength(candidate, font=font) > width:
+            lines.append(line)
+            line = word
+        else:
+            line = candidate
+    lines.append(line)
+    
+    if len(lines) > max_lines:
+        lines = lines[:max_lines]
+        while lines[-1] and draw.textlength(lines[-1] + '…', font=font) > width:
+            lines[-1] = lines[-1][:-1]
+        lines[-1] += '…'
+    return lines
+
+
+def render_card(thumbnail, title, subtitle, footer, output_path):
+    """Blocking: draw a now-playing card as a JPEG at output_path"""
+    import io
+    from PIL import Image, ImageDraw, ImageFilter, ImageOps
+    
+    width, height = CARD_SIZE
+    cover = None
+    if thumbnail:
+        art = Image.open(io.BytesIO(thumbnail)).convert('RGB')
+        card = ImageOps.fit(art, CARD_SIZE).filter(ImageFilter.GaussianBlur(30))
+        card = Image.blend(card, Image.new('RGB', CARD_SIZE), 0.55)
+        cover = ImageOps.fit(art, (480, 480))
+    else:
+        card = Image.new('RGB', CARD_SIZE, (24, 24, 32))
+    
+    draw = ImageDraw.Draw(card)
+    x = 80
+    if cover:
+        card.paste(cover, (80, 120))
+        x = 620
+    
+    title_font, small_font = load_card_font(56, bold=True), load_card_font(34)
+    y = 150
+    for line in wrap_card_text(draw, title, title_font, width - x - 80, max_lines=3):
+        draw.text((x, y), line, font=title_font, fill=(255, 255, 255))
+        y += 70
+    draw.text((x, y + 20), subtitle, font=small_font, fill=(200, 200, 200))
+    draw.text((x, 560), footer, font=small_font, fill=(255, 255, 255))
+    
+    tmp_path = f"{output_path}.tmp"
+    card.save(tmp_path, 'JPEG', quality=88)
+    os.replace(tmp_path, output_path)
+
+QUALITY_LEVELS = ('high', 'medium', 'low')  # 720p / 480p / 360p video
+
+
+class ResourceGovernor:
+    """Steps single streams down in quality under CPU pressure and holds new joins when the host is saturated"""
+
+    def __init__(self, high_water=85, low_water=60, critical=95):
+        self.high_water = high_water
+        self.low_water = low_water
+        self.critical = critical
+        self.levels = {}  # chat_id: index into QUALITY_LEVELS
+        self.stream_paths = {}  # chat_id: input ffmpeg was started with
+        self.stream_cost = {}  # chat_id: ffmpeg CPU percent
+        self.host_cpu = 0.0
+        self.stats = Counter()  # stepped_down, stepped_up, join_waits, join_timeouts
+        self._over = 0
+        self._under = 0
+        self._processes = {}  # pid: psutil.Process, kept so cpu_percent has a baseline
+        self._capacity = asyncio.Event()
+        self._capacity.set()
+
+    @property
+    def default_level(self):
+        """Quality for a chat that starts streaming now"""
+        if self.host_cpu >= self.critical:
+            return 2
+        return 1 if self.host_cpu >= self.high_water else 0
+
+    def level(self, chat_id):
+        return self.levels.setdefault(chat_id, self.default_level)
+
+    def forget(self, chat_id):
+        self.levels.pop(chat_id, None)
+        self.stream_paths.pop(chat_id, None)
+        self.stream_cost.pop(chat_id, None)
+
+    def sample(self):
+        """Blocking: measure host CPU and attribute ffmpeg children to chats by their input"""
+        import psutil
+        
+        self.host_cpu = psutil.cpu_percent(interval=None)
+        processes = {}
+        for child in psutil.Process().children(recursive=True):
+            try:
+                if 'ffmpeg' in child.name():
+                    processes[child.pid] = self._processes.get(child.pid, child)
+            except psutil.Error:
+                continue
+        self._processes = processes
+        
+        cost = Counter()
+        for process in processes.values():
+            try:
+                cmdline = process.cmdline()
+                usage = process.cpu_percent(interval=None)
+            except psutil.Error:
+                continue
+            for chat_id, path in self.stream_paths.items():
+                if path in cmdline:
+                    cost[chat_id] += usage
+                    break
+        self.stream_cost = dict(cost)
+
+    def plan(self):
+        """One (chat_id, level) change with hysteresis, or None"""
+        if self.host_cpu >= self.high_water:
+            self._over, self._under = self._over + 1, 0
+        elif self.host_cpu <= self.low_water:
+            self._over, self._under = 0, self._under + 1
+        else:
+            self._over = self._under = 0
+        
+        degradable = [chat_id for chat_id in self.stream_paths if self.level(chat_id) < len(QUALITY_LEVELS) - 1]
+        if self.host_cpu >= self.critical and not degradable:
+            self._capacity.clear()
+        else:
+            self._capacity.set()
+        
+        # Only the costliest stream pays for pressure, the rest keep their quality
+        if self._over >= 2 and degradable:
+            self._over = 0
+            chat_id = max(degradable, key=lambda chat_id: self.stream_cost.get(chat_id, 0))
+            self.stats['stepped_down'] += 1
+            return chat_id, self.level(chat_id) + 1
+        
+        degraded = [chat_id for chat_id in self.stream_paths if self.level(chat_id) > 0]
+        if self._under >= 3 and degraded:
+            self._under = 0
+            chat_id = max(degraded, key=lambda chat_id: (self.level(chat_id), -self.stream_cost.get(chat_id, 0)))
+            self.stats['stepped_up'] += 1
+            return chat_id, self.level(chat_id) - 1
+        return None
+
+    async def wait_for_capacity(self, timeout):
+        """Hold a new join while every running stream is already at the lowest quality and CPU is pegged"""
+        if self._capacity.is_set():
+            return
+        self.stats['join_waits'] += 1
+        try:
+            await asyncio.wait_for(self._capacity.wait(), timeout)
+        except asyncio.TimeoutError:
+            self.stats['join_timeouts'] += 1
+
+
+class ChatActor:
+    """Runs one chat's playback commands one at a time, in arrival order"""
+
+    def __init__(self, chat_id):
+        self.chat_id = chat_id
+        self.mailbox = deque()  # (func, args, future, enqueued_at, trace)
+        self.task = None  # running only while the mailbox has work
+        self.processed = 0
+        self.busy_time = 0.0
+        self.max_time = 0.0
+        self.max_depth = 0
+
+    @property
+    def depth(self):
+        return len(self.mailbox) + (self.task is not None)
+
+    def submit(self, func, *args):
+        future = asyncio.get_running_loop().create_future()
+        self.mailbox.append((func, args, future, time.monotonic(), tracer.capture()))
+        self.max_depth = max(self.max_depth, self.depth)
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+        return future
+
+    async def _run(self):
+        try:
+            while self.mailbox:
+                func, args, future, enqueued_at, trace = self.mailbox.popleft()
+                if future.done():
+                    continue  # caller gave up while waiting
+                
+                started = time.monotonic()
+                try:
+                    # The command's trace continues on the actor
+                    with tracer.resume(trace), tracer.span('actor', chat_id=self.chat_id, queued_ms=int((started - enqueued_at) * 1000)):
+                        result = await func(*args)
+                except asyncio.CancelledError:
+                    future.cancel()
+                    raise
+                except BaseException as e:
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    # The caller may have been cancelled while the command ran
+                    if not future.done():
+                        future.set_result(result)
+                elapsed = time.monotonic() - started
+                self.processed += 1
+                self.busy_time += elapsed
+                self.max_time = max(self.max_time, elapsed)
+                if elapsed > 5:
+                    logger.warning(f"Chat {self.chat_id} command {getattr(func, 'func', func).__name__} took {elapsed:.1f}s "
+                                   f"after waiting {started - enqueued_at:.1f}s")
+        except asyncio.CancelledError:
+            # Nothing will run the rest of the mailbox, don't leave its callers waiting
+            while self.mailbox:
+                self.mailbox.popleft()[2].cancel()
+            raise
+        finally:
+            self.task = None
+
+
+class HandoverStore:
+    """Playback checkpoints passed from a draining instance to its replacement
+
+    Kept in Redis when a URL is configured, since most hosts give each container
+    its own disk; otherwise in a SQLite file that both instances must mount.
+    """
+
+    def __init__(self, redis_url=None, path='data/handover.db', namespace='tgmusic'):
+        self.redis_url = redis_url
+        self.key = f"{namespace}:playback_checkpoints"
+        self._redis = None
+        self.conn = None
+        if not redis_url:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS playback_checkpoints (
+                    chat_id INTEGER PRIMARY KEY,
+                    current_item TEXT,
+                    position REAL,
+                    paused BOOLEAN,
+                    queue TEXT,
+                    autoplay BOOLEAN,
+                    saved_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            self.conn.commit()
+
+    @property
+    def redis(self):
+        import redis.asyncio as aioredis
+        
+        if self._redis is None:
+            self._redis = aioredis.from_url(self.redis_url)
+        return self._redis
+
+    async def save(self, chat_id, current_item, position, paused, queue_items, autoplay):
+        row = (chat_id, current_item, position, paused, queue_items, autoplay)
+        if self.redis_url:
+            await self.redis.hset(self.key, str(chat_id), json.dumps(row))
+            return
+        self.conn.execute('''
+            INSERT OR REPLACE INTO playback_checkpoints (chat_id, current_item, position, paused, queue, autoplay)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', row)
+        self.conn.commit()
+
+    async def take_all(self):
+        """Remove and return every checkpoint, so each chat is resumed by one instance only"""
+        if self.redis_url:
+            async with self.redis.pipeline(transaction=True) as pipe:
+                saved, _ = await pipe.hgetall(self.key).delete(self.key).execute()
+            return [tuple(json.loads(row)) for row in saved.values()]
+        
+        cursor = self.conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute('SELECT chat_id, current_item, position, paused, queue, autoplay FROM playback_checkpoints')
+        rows = cursor.fetchall()
+        cursor.execute('DELETE FROM playback_checkpoints')
+        self.conn.commit()
+        return rows
+
+
+def chat_serialized(method):
+    """Run a bot method on the actor of the chat named by its first argument (chat id, event or update)"""
+    @wraps(method)
+    async def wrapper(self, target, *args, **kwargs):
+        chat_id = target if isinstance(target, int) else target.chat_id
+        return await self.dispatch(chat_id, partial(method, self, target, *args, **kwargs))
+    return wrapper
+
+
 class EnhancedMusicBot:
     def __init__(self):
         # Environment variables
@@ -34,12 +1362,133 @@ class EnhancedMusicBot:
         # Bot state
         self.queue = {}  # chat_id: [songs]
         self.current_playing = {}  # chat_id: song_info
+        self.playback_positions = {}  # chat_id: {'offset': seconds, 'started_at': monotonic or None if paused}
+        self.history_page_size = 10
+        self.max_batch_size = int(os.getenv('MAX_BATCH_SIZE', '25'))
+        self.queue_versions = Counter()  # chat_id: bumped on every queue change
+        self.queue_pages = {}  # (chat_id, page): (version, text, buttons)
+        self.queue_page_size = 10
+        self.autoplay_chats = set()
+        self.autoplay_next = {}  # chat_id: (source url, pre-resolve task)
         self.premium_users = set()
-        self.user_sessions = {}
+        
+        # Idle chats are released after this many quiet seconds (0 disables)
+        self.idle_timeout = int(os.getenv('IDLE_TIMEOUT', '300'))
+        self.last_activity = {}  # chat_id: monotonic time of the last playback change
+        self.reaper_stats = Counter()
+        
+        # CPU-aware stream quality
+        self.governor = ResourceGovernor(
+            high_water=int(os.getenv('CPU_HIGH_WATER', '85')),
+            low_water=int(os.getenv('CPU_LOW_WATER', '60')),
+            critical=int(os.getenv('CPU_CRITICAL', '95'))
+        )
+        self.join_wait_seconds = int(os.getenv('JOIN_WAIT_SECONDS', '30'))
+        
+        # Graceful drain on SIGTERM and handover to the next instance
+        self.draining = False
+        self.drain_grace = int(os.getenv('DRAIN_GRACE_SECONDS', '20'))
+        self.handover_window = int(os.getenv('HANDOVER_WINDOW_SECONDS', '120'))
+        self.handover_store = HandoverStore(
+            redis_url=os.getenv('REDIS_URL'),
+            path=os.getenv('HANDOVER_DB', 'data/handover.db'),
+            namespace=self.session_name
+        )
+        
+        # Playback state of each chat is only mutated from that chat's actor
+        self.chat_actors = {}  # chat_id: ChatActor
+        self.actor_totals = Counter()  # work done by actors that were dropped
+        
+        # Event loop watchdog (opt-in)
+        self.loop_watchdog = None
+        if os.getenv('LOOP_WATCHDOG', 'false').lower() == 'true':
+            self.loop_watchdog = LoopLagWatchdog(
+                threshold=float(os.getenv('LOOP_LAG_THRESHOLD_MS', '250')) / 1000
+            )
+        self.profile_max_seconds = int(os.getenv('PROFILE_MAX_SECONDS', '120'))
+        self.profiling = False
+        tracer.configure(
+            os.getenv('TRACE_FILE', 'logs/traces.jsonl'),
+            sample_rate=float(os.getenv('TRACE_SAMPLE_RATE', '0.1')),
+            max_bytes=int(os.getenv('TRACE_MAX_MB', '20')) * 1024 * 1024
+        )
+        
+        # Global download scheduler
+        self.download_scheduler = DownloadScheduler(
+            max_concurrent=int(os.getenv('MAX_CONCURRENT_DOWNLOADS', '3')),
+            bandwidth_limit=int(os.getenv('DOWNLOAD_BANDWIDTH_LIMIT_KBPS', '0')) * 1024
+        )
+        self.ranged_downloader = RangedDownloader(
+            segments=int(os.getenv('DOWNLOAD_SEGMENTS', '4'))
+        )
+        self.inflight_downloads = {}  # source path: download task
+        
+        # Admission limits checked against metadata before downloading
+        self.admission_limits = {
+            'free': {
+                'duration': int(os.getenv('MAX_DURATION_FREE', '1800')),
+                'filesize': int(os.getenv('MAX_FILESIZE_FREE_MB', '100')) * 1024 * 1024,
+            },
+            'premium': {
+                'duration': int(os.getenv('MAX_DURATION_PREMIUM', '10800')),
+                'filesize': int(os.getenv('MAX_FILESIZE_PREMIUM_MB', '1024')) * 1024 * 1024,
+            },
+        }
+        self.allow_live_streams = os.getenv('ALLOW_LIVE_STREAMS', 'true').lower() == 'true'
+        self.live_max_reconnects = int(os.getenv('LIVE_MAX_RECONNECTS', '10'))
+        self.extractor_pool = ExtractorPool(
+            size=int(os.getenv('EXTRACTOR_POOL_SIZE', str(self.download_scheduler.max_concurrent)))
+        )
+        
+        # Per-source health of metadata extraction
+        self.extract_timeout = int(os.getenv('EXTRACT_TIMEOUT', '20'))
+        self.breaker_threshold = int(os.getenv('SOURCE_FAILURE_THRESHOLD', '3'))
+        self.breaker_reset = int(os.getenv('SOURCE_RETRY_SECONDS', '60'))
+        self.fallback_search = os.getenv('FALLBACK_SEARCH', 'scsearch')  # yt-dlp search prefix, empty disables
+        self.source_probe_query = os.getenv('SOURCE_PROBE_QUERY', 'music')
+        self.source_breakers = {}  # source: CircuitBreaker
+        # Timed-out extractions keep their thread until yt-dlp gives up, so they get their own
+        self.extract_executor = ThreadPoolExecutor(max_workers=self.extractor_pool.size, thread_name_prefix='extract')
+        
+        # Local transcode pool for derived variants
+        self.transcode_semaphore = asyncio.Semaphore(int(os.getenv('TRANSCODE_WORKERS', str(max(1, (os.cpu_count() or 2) // 2)))))
+        self.inflight_transcodes = {}  # output path: transcode task
+        
+        # Now-playing cards: rendered once per track and template, uploaded once per process
+        self.card_executor = ThreadPoolExecutor(max_workers=int(os.getenv('CARD_WORKERS', '2')), thread_name_prefix='card')
+        self.card_refs = {}  # (track_id, template): uploaded Telegram photo
+        self.inflight_cards = {}  # card path: render task
+        self.max_cards = int(os.getenv('MAX_CACHED_CARDS', '500'))
+        
+        # Loudness is measured once per cached source and applied as a static gain
+        self.loudness_target = float(os.getenv('LOUDNESS_TARGET', '-14'))  # LUFS
+        self.normalize_loudness = os.getenv('NORMALIZE_LOUDNESS', 'true').lower() == 'true'
+        self.inflight_loudness = {}  # track_id: analysis task
+        
+        # Popular tracks are fetched ahead of demand while the cache is cold after a restart
+        self.warm_top_n = int(os.getenv('WARM_CACHE_TOP_N', '50'))  # 0 disables
+        self.warm_history_days = int(os.getenv('WARM_CACHE_DAYS', '14'))
+        self.search_cache_days = int(os.getenv('SEARCH_CACHE_DAYS', '7'))
+        self.cold_start_until = time.monotonic() + int(os.getenv('COLD_START_WINDOW_SECONDS', '3600'))
+        self.warm_stats = Counter()
+        self.cache_lookups = Counter()  # media cache hits and misses of user requests
+        
+        # Tiered media storage
+        default_hot_dir = '/dev/shm/tgmusic' if os.path.isdir('/dev/shm') else ''
+        self.media_store = TieredMediaStore(
+            'downloads',
+            hot_dir=os.getenv('HOT_CACHE_DIR', default_hot_dir),
+            hot_budget=int(os.getenv('HOT_CACHE_MB', '256')) * 1024 * 1024,
+            cold_budget=int(os.getenv('COLD_CACHE_MB', '4096')) * 1024 * 1024
+        )
         
         # Initialize database
         self.init_db()
         
+        # Local music library
+        library_dirs = [d for d in os.getenv('LIBRARY_DIRS', '').split(os.pathsep) if d]
+        self.library = MusicLibrary(self.conn, library_dirs)
+        
         # Initialize clients
         self.app = TelegramClient(
             self.session_name,
@@ -47,21 +1496,24 @@ class EnhancedMusicBot:
             self.api_hash
         )
         
-        self.call_py = PyTgCalls(self.app)
+        self.call_py = None  # created in start() once pytgcalls is imported
         
         # YT-DLP configuration
         self.ytdl_opts = {
             'format': 'best[height<=720]/best',
-            'outtmpl': 'downloads/%(title)s.%(ext)s',
+            'outtmpl': 'downloads/%(extractor)s-%(id)s.%(ext)s',
             'quiet': True,
             'no_warnings': True,
             'extractaudio': False,
             'keepvideo': True,
+            'socket_timeout': self.extract_timeout,
         }
         
         # Create necessary directories
         Path("downloads").mkdir(exist_ok=True)
         Path("sessions").mkdir(exist_ok=True)
+        Path("profiles").mkdir(exist_ok=True)
+        Path("cards").mkdir(exist_ok=True)
 
     def init_db(self):
         """Initialize SQLite database"""
@@ -117,23 +1569,153 @@ class EnhancedMusicBot:
             )
         ''')
         
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_song_history_chat ON song_history (chat_id, id)')
+        self.init_history_search(cursor)
+        
+        self.init_coplay_graph(cursor)
+        
+        # Media cache index, one row per fetched source
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS media_cache (
+                track_id TEXT,
+                media_type TEXT,
+                title TEXT,
+                duration INTEGER,
+                webpage_url TEXT,
+                thumbnail TEXT,
+                uploader TEXT,
+                view_count INTEGER,
+                file_path TEXT,
+                cached_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (track_id, media_type)
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_media_cache_url ON media_cache (webpage_url, media_type)')
+        cursor.execute('PRAGMA table_info(media_cache)')
+        if 'loudness_gain' not in {row[1] for row in cursor.fetchall()}:
+            cursor.execute('ALTER TABLE media_cache ADD COLUMN loudness_gain REAL')
+        
+        # Text searches resolved recently, so repeats skip extraction
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS search_cache (
+                query TEXT,
+                media_type TEXT,
+                webpage_url TEXT,
+                cached_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (query, media_type)
+            )
+        ''')
+        
         self.conn.commit()
 
+    def init_history_search(self, cursor):
+        """Full-text index over song_history titles, falling back to LIKE without FTS5"""
+        cursor.execute("SELECT sql FROM sqlite_master WHERE name = 'song_history_fts'")
+        row = cursor.fetchone()
+        exists = row is not None and 'chat_id' in row[0]
+        try:
+            if row and not exists:
+                # Indexes from before chat_id was indexed matched every chat's rows
+                cursor.executescript('''
+                    DROP TRIGGER IF EXISTS song_history_ai;
+                    DROP TRIGGER IF EXISTS song_history_ad;
+                    DROP TABLE song_history_fts;
+                ''')
+            cursor.execute('''
+                CREATE VIRTUAL TABLE IF NOT EXISTS song_history_fts USING fts5(
+                    song_title, chat_id, content='song_history', content_rowid='id'
+                )
+            ''')
+            cursor.executescript('''
+                CREATE TRIGGER IF NOT EXISTS song_history_ai AFTER INSERT ON song_history BEGIN
+                    INSERT INTO song_history_fts (rowid, song_title, chat_id) VALUES (new.id, new.song_title, new.chat_id);
+                END;
+                CREATE TRIGGER IF NOT EXISTS song_history_ad AFTER DELETE ON song_history BEGIN
+                    INSERT INTO song_history_fts (song_history_fts, rowid, song_title, chat_id)
+                    VALUES ('delete', old.id, old.song_title, old.chat_id);
+                END;
+            ''')
+            if not exists:
+                # Index history recorded before the FTS table existed
+                cursor.execute("INSERT INTO song_history_fts (song_history_fts) VALUES ('rebuild')")
+            self.history_fts = True
+        except sqlite3.OperationalError as e:
+            logger.warning(f"History search falls back to LIKE, SQLite FTS5 unavailable: {e}")
+            self.history_fts = False
+
+    def init_coplay_graph(self, cursor):
+        """Graph of tracks played back to back, seeded once from song_history"""
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'coplay_edges'")
+        exists = cursor.fetchone() is not None
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS coplay_edges (
+                src_url TEXT,
+                dst_url TEXT,
+                dst_title TEXT,
+                weight INTEGER DEFAULT 0,
+                last_played DATETIME,
+                PRIMARY KEY (src_url, dst_url)
+            )
+        ''')
+        if not exists:
+            cursor.execute('''
+                INSERT INTO coplay_edges (src_url, dst_url, dst_title, weight, last_played)
+                SELECT src_url, dst_url, dst_title, COUNT(*), MAX(played_at) FROM (
+                    SELECT LAG(song_url) OVER (PARTITION BY chat_id ORDER BY id) AS src_url,
+                           song_url AS dst_url, song_title AS dst_title, played_at
+                    FROM song_history
+                )
+                WHERE src_url != '' AND dst_url != '' AND src_url != dst_url
+                GROUP BY src_url, dst_url
+            ''')
+
     async def start(self):
         """Start the enhanced bot"""
+        # Import pytgcalls in a thread while the Telegram client connects
+        pytgcalls_import = asyncio.create_task(asyncio.to_thread(importlib.import_module, 'pytgcalls'))
         await self.app.start(bot_token=self.bot_token)
+        await pytgcalls_import
+        
+        from pytgcalls import PyTgCalls
+        self.call_py = PyTgCalls(self.app)
         await self.call_py.start()
         
-        logger.info("Enhanced Music Bot started successfully!")
+        # Resume chats handed over by a previous instance before taking new commands
+        self.media_store.start()
+        await self.restore_checkpoints()
+        
+        logger.info(f"Enhanced Music Bot started successfully! Ready in {time.perf_counter() - PROCESS_START:.2f}s")
         
         # Register event handlers
         self.register_handlers()
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(self.drain()))
+        except NotImplementedError:
+            pass  # no signal handlers on Windows event loops
         
         # Start background tasks
+        self.started_at = datetime.now()
+        asyncio.create_task(self.warm_extractors())
+        if self.handover_window:
+            asyncio.create_task(self.watch_handover())
+        if self.library.enabled:
+            asyncio.create_task(self.library.watch(
+                interval=int(os.getenv('LIBRARY_WATCH_INTERVAL', '30')),
+                full_scan_every=int(os.getenv('LIBRARY_RESCAN_HOURS', '24')) * 3600
+            ))
+        if self.loop_watchdog:
+            asyncio.create_task(self.loop_watchdog.run())
         asyncio.create_task(self.cleanup_old_files())
         asyncio.create_task(self.update_premium_status())
+        if self.idle_timeout:
+            asyncio.create_task(self.reap_idle_chats())
+        asyncio.create_task(self.probe_sources())
+        asyncio.create_task(self.govern_streams())
+        if self.warm_top_n:
+            asyncio.create_task(self.warm_media_cache())
         
         await self.app.run_until_disconnected()
+        await self.ranged_downloader.close()
 
     def register_handlers(self):
         """Register all event handlers"""
@@ -158,6 +1740,10 @@ class EnhancedMusicBot:
         async def queue_handler(event):
             await self.handle_queue(event)
         
+        @self.app.on(events.CallbackQuery(pattern=rb'queue:(\d+)'))
+        async def queue_page_handler(event):
+            await self.handle_queue_page(event)
+        
         @self.app.on(events.NewMessage(pattern=r'/skip'))
         async def skip_handler(event):
             await self.handle_skip(event)
@@ -178,6 +1764,26 @@ class EnhancedMusicBot:
         async def volume_handler(event):
             await self.handle_volume(event)
         
+        @self.app.on(events.NewMessage(pattern=r'/seek'))
+        async def seek_handler(event):
+            await self.handle_seek(event)
+        
+        @self.app.on(events.NewMessage(pattern=r'/effect'))
+        async def effect_handler(event):
+            await self.handle_effect(event)
+        
+        @self.app.on(events.NewMessage(pattern=r'/history'))
+        async def history_handler(event):
+            await self.handle_history(event)
+        
+        @self.app.on(events.NewMessage(pattern=r'/replay'))
+        async def replay_handler(event):
+            await self.handle_replay(event)
+        
+        @self.app.on(events.NewMessage(pattern=r'/autoplay'))
+        async def autoplay_handler(event):
+            await self.handle_autoplay(event)
+        
         @self.app.on(events.NewMessage(pattern=r'/current'))
         async def current_handler(event):
             await self.handle_current(event)
@@ -199,6 +1805,14 @@ class EnhancedMusicBot:
         async def stats_handler(event):
             await self.handle_stats(event)
         
+        @self.app.on(events.NewMessage(pattern=r'/trace'))
+        async def trace_handler(event):
+            await self.handle_trace(event)
+        
+        @self.app.on(events.NewMessage(pattern=r'/profile'))
+        async def profile_handler(event):
+            await self.handle_profile(event)
+        
         @self.app.on(events.NewMessage(pattern=r'/broadcast'))
         async def broadcast_handler(event):
             await self.handle_broadcast(event)
@@ -213,6 +1827,7 @@ class EnhancedMusicBot:
         async def stream_end_handler(_, update):
             await self.on_stream_end(update)
 
+    @traced_command
     async def handle_start(self, event):
         """Enhanced start command"""
         user_id = event.sender_id
@@ -238,15 +1853,20 @@ class EnhancedMusicBot:
 Hi {first_name}! I can stream high-quality music and videos in Telegram voice chats!
 
 **🎶 Music Commands:**
-• `/play <song>` - Play audio in voice chat
+• `/play <song>` - Play audio in voice chat (one song per line to queue several)
 • `/vplay <video>` - Play video in voice chat  
-• `/queue` - Show current playlist
+• `/queue [page]` - Show current playlist
 • `/skip` - Skip current song
 • `/pause` - Pause playback
 • `/resume` - Resume playback
 • `/stop` - Stop and clear queue
 • `/volume <1-200>` - Adjust volume
 • `/current` - Show current playing song
+• `/seek <mm:ss>` - Jump to a position in the track
+• `/history [page|search]` - Show recently played songs
+• `/replay <n|search>` - Play a song from history again
+• `/autoplay [on|off]` - Keep playing related songs when the queue ends
+• `/effect <name|off> [queue #]` - Bass boost, nightcore and more
 
 **💎 Premium Features:**
 • 🎵 High-quality audio (320kbps)
@@ -266,19 +1886,20 @@ Join voice chat first, then use music commands!
         
         await event.respond(welcome_msg)
 
+    @traced_command
     async def handle_play(self, event):
         """Handle audio play command"""
         if not await self.check_permissions(event):
             return
         
         chat_id = event.chat_id
-        message_parts = event.message.message.split(' ', 1)
+        message_parts = event.message.message.split(None, 1)
+        queries = [query.strip() for query in re.split(r'[\n;]+', message_parts[1]) if query.strip()] if len(message_parts) > 1 else []
         
-        if len(message_parts) < 2:
-            await event.respond("❌ **Usage:** `/play <song name or URL>`")
+        if not queries:
+            await event.respond("❌ **Usage:** `/play <song name or URL>`\nSeveral songs: one per line or separated by `;`")
             return
         
-        query = message_parts[1]
         is_premium = await self.is_premium_user(event.sender_id)
         
         # Check queue limits
@@ -286,41 +1907,85 @@ Join voice chat first, then use music commands!
             await event.respond("❌ **Queue limit reached!** Upgrade to premium for unlimited queue.")
             return
         
+        if len(queries) > 1:
+            await self.play_batch(event, queries, is_premium)
+            return
+        
+        query = queries[0]
         status_msg = await event.respond("🔍 **Searching for music...**")
         
         try:
-            song_info = await self.download_media(query, is_premium, media_type='audio')
+            priority = self.download_priority(chat_id, is_premium)
+            song_info = await self.download_media(query, is_premium, media_type='audio', priority=priority)
             
             if not song_info:
                 await status_msg.edit("❌ **Could not find the requested song.**")
                 return
             
-            # Add to queue
-            queue_item = {
-                'info': song_info,
-                'requested_by': event.sender.first_name,
-                'user_id': event.sender_id,
-                'type': 'audio',
-                'chat_id': chat_id
-            }
-            
-            if chat_id not in self.queue:
-                self.queue[chat_id] = []
-            
-            self.queue[chat_id].append(queue_item)
-            
-            # Start playing if nothing is currently playing
-            if chat_id not in self.current_playing:
-                await self.play_next_in_queue(chat_id)
-                await status_msg.edit(f"🎵 **Now Playing:**\n**{song_info['title']}**\n👤 Requested by {event.sender.first_name}")
-            else:
-                queue_position = len(self.queue[chat_id])
-                await status_msg.edit(f"✅ **Added to queue (#{queue_position})**\n🎵 **{song_info['title']}**\n👤 {event.sender.first_name}")
+            await self.enqueue_track(event, status_msg, song_info, 'audio')
                 
+        except MediaRejected as e:
+            await status_msg.edit(f"❌ **{e}**")
         except Exception as e:
             logger.error(f"Play command error: {e}")
             await status_msg.edit("❌ **Error processing your request. Please try again.**")
 
+    async def play_batch(self, event, queries, is_premium):
+        """Resolve several queries at once, queue them in the order given and report in one message"""
+        chat_id = event.chat_id
+        limit = self.max_batch_size if is_premium else max(0, 10 - len(self.queue.get(chat_id, [])))
+        skipped = len(queries) - limit
+        queries = queries[:limit]
+        
+        status_msg = await event.respond(f"🔍 **Searching for {len(queries)} songs...**")
+        lines = [f"⏳ {query}" for query in queries]
+        last_edit = 0.0
+        
+        async def report(final=False):
+            nonlocal last_edit
+            # Coalesce edits to stay clear of Telegram's edit rate limits
+            if not final and time.monotonic() - last_edit < 2:
+                return
+            last_edit = time.monotonic()
+            done = sum(1 for line in lines if not line.startswith('⏳'))
+            header = f"🎵 **Batch: {done}/{len(lines)} resolved**" if not final else f"🎵 **Queued {sum(1 for line in lines if line.startswith(('▶️', '✅')))} of {len(lines)} songs**"
+            limit_note = f"one /play takes up to {self.max_batch_size} songs" if is_premium else "free queues hold 10 songs"
+            footer = f"\n\n⚠️ **{skipped} more skipped** - {limit_note}" if skipped > 0 else ""
+            try:
+                await status_msg.edit(header + "\n\n" + '\n'.join(lines) + footer)
+            except MessageNotModifiedError:
+                pass
+        
+        async def resolve(query):
+            async with resolve_slots:
+                return await self.download_media(query, is_premium, media_type='audio', priority=self.download_priority(chat_id, is_premium))
+        
+        # Extraction runs concurrently, bounded by the extractor pool
+        resolve_slots = asyncio.Semaphore(self.extractor_pool.size)
+        tasks = [asyncio.create_task(resolve(query)) for query in queries]
+        try:
+            # Enqueue strictly in the order given, each as soon as it and everything before it resolved
+            for index, (query, task) in enumerate(zip(queries, tasks)):
+                try:
+                    media = await task
+                except MediaRejected as e:
+                    lines[index] = f"❌ {query} - {e}"
+                    media = None
+                
+                if media is None:
+                    if not lines[index].startswith('❌'):
+                        lines[index] = f"❌ {query} - not found"
+                else:
+                    queue_position = await self.add_to_queue(chat_id, self.queue_item(event, media))
+                    lines[index] = f"▶️ {media['title']}" if not queue_position else f"✅ #{queue_position} {media['title']}"
+                await report()
+        finally:
+            for task in tasks:
+                task.cancel()
+        
+        await report(final=True)
+
+    @traced_command
     async def handle_video_play(self, event):
         """Handle video play command"""
         if not await self.check_permissions(event):
@@ -342,159 +2007,1010 @@ Join voice chat first, then use music commands!
         status_msg = await event.respond("🔍 **Searching for video...**")
         
         try:
-            video_info = await self.download_media(query, is_premium=True, media_type='video')
+            priority = self.download_priority(chat_id, is_premium=True)
+            video_info = await self.download_media(query, is_premium=True, media_type='video', priority=priority)
             
             if not video_info:
                 await status_msg.edit("❌ **Could not find the requested video.**")
                 return
             
-            # Add to queue
-            queue_item = {
-                'info': video_info,
-                'requested_by': event.sender.first_name,
-                'user_id': event.sender_id,
-                'type': 'video',
-                'chat_id': chat_id
-            }
-            
-            if chat_id not in self.queue:
-                self.queue[chat_id] = []
-            
-            self.queue[chat_id].append(queue_item)
-            
-            # Start playing if nothing is currently playing
-            if chat_id not in self.current_playing:
-                await self.play_next_in_queue(chat_id)
-                await status_msg.edit(f"🎥 **Now Playing Video:**\n**{video_info['title']}**\n👤 Requested by {event.sender.first_name}")
-            else:
-                queue_position = len(self.queue[chat_id])
-                await status_msg.edit(f"✅ **Added to queue (#{queue_position})**\n🎥 **{video_info['title']}**\n👤 {event.sender.first_name}")
+            await self.enqueue_track(event, status_msg, video_info, 'video')
                 
+        except MediaRejected as e:
+            await status_msg.edit(f"❌ **{e}**")
         except Exception as e:
             logger.error(f"Video play command error: {e}")
             await status_msg.edit("❌ **Error processing your request. Please try again.**")
 
-    async def download_media(self, query, is_premium=False, media_type='audio'):
-        """Download audio or video with yt-dlp"""
+    def download_priority(self, chat_id, is_premium):
+        """Scheduler priority for a track requested in this chat"""
+        if chat_id not in self.current_playing or not self.queue.get(chat_id):
+            return PRIORITY_PLAYBACK  # will play now or next
+        return PRIORITY_PREMIUM if is_premium else PRIORITY_FREE
+
+    def ytdl_options(self, media_type):
+        """yt-dlp options for a media type's pooled extractors"""
         ytdl_opts = self.ytdl_opts.copy()
+        ytdl_opts['progress_hooks'] = [self.download_scheduler.progress_hook]
         
         if media_type == 'audio':
-            if is_premium:
-                ytdl_opts['format'] = 'bestaudio[abr>=320]/bestaudio/best'
-            else:
-                ytdl_opts['format'] = 'bestaudio[abr<=128]/bestaudio/best'
+            ytdl_opts['format'] = 'bestaudio/best'
         else:  # video
             ytdl_opts['format'] = 'best[height<=720]/best'
+            ytdl_opts['outtmpl'] = 'downloads/%(extractor)s-%(id)s.video.%(ext)s'
+        
+        return ytdl_opts
+
+    async def warm_extractors(self):
+        """Background task pre-initializing the extractor pool"""
+        started = time.perf_counter()
+        try:
+            await asyncio.to_thread(self.extractor_pool.warm, {
+                media_type: self.ytdl_options(media_type) for media_type in ('audio', 'video')
+            })
+            logger.info(f"Extractor pool warmed in {time.perf_counter() - started:.2f}s")
+        except Exception as e:
+            logger.error(f"Extractor warmup error: {e}")
+
+    async def enqueue_track(self, event, status_msg, media, media_type='audio'):
+        """Queue resolved media in the event's chat, starting playback if idle"""
+        queue_position = await self.add_to_queue(event.chat_id, self.queue_item(event, media, media_type))
+        media_icon = "🎥" if media_type == 'video' else "🎵"
+        
+        # Start playing if nothing is currently playing
+        if not queue_position:
+            now_playing = "Now Playing Video" if media_type == 'video' else "Now Playing"
+            await status_msg.edit(f"{media_icon} **{now_playing}:**\n**{media['title']}**\n👤 Requested by {event.sender.first_name}")
+        else:
+            await status_msg.edit(f"✅ **Added to queue (#{queue_position})**\n{media_icon} **{media['title']}**\n👤 {event.sender.first_name}")
+
+    def queue_item(self, event, media, media_type='audio'):
+        return {
+            'info': media,
+            'requested_by': event.sender.first_name,
+            'user_id': event.sender_id,
+            'type': media_type,
+            'chat_id': event.chat_id
+        }
+
+    @chat_serialized
+    @tracer.traced('enqueue')
+    async def add_to_queue(self, chat_id, queue_item):
+        """Append to the chat's queue; returns the queue position, or 0 if it started playing"""
+        if chat_id not in self.queue:
+            self.queue[chat_id] = []
+        
+        self.queue[chat_id].append(queue_item)
+        self.queue_changed(chat_id)
+        self.refresh_pins(chat_id)
+        self.touch_chat(chat_id)
+        
+        if chat_id not in self.current_playing:
+            await self.play_next_in_queue(chat_id)
+            return 0
+        return len(self.queue[chat_id])
+
+    @tracer.traced('download_media')
+    async def download_media(self, query, is_premium=False, media_type='audio', priority=PRIORITY_FREE):
+        """Fetch the best source once and return the variant for the user's tier"""
+        # Search if not a direct URL
+        if not (query.startswith('http://') or query.startswith('https://')):
+            search_query = f"ytsearch1:{query}"
+        else:
+            search_query = query
+        
+        try:
+            if query.startswith('file://'):
+                path = url2pathname(urlparse(query).path)
+                if not self.library.contains(path):
+                    raise MediaRejected("Only files from the local library can be played")
+                return self.local_file_media(path)
+            
+            # Licensed local files are served before going to YouTube
+            if search_query != query and media_type == 'audio':
+                local = self.library_media(query)
+                if local:
+                    return local
+            
+            if search_query == query:
+                radio = await self.probe_radio_stream(query)
+                if radio:
+                    self.check_admission(radio, is_premium)
+                    return radio
+            
+            media = await self.resolve_source(query, search_query, media_type, priority, is_premium)
+            
+            if media_type == 'audio' and not media.get('is_live'):
+                variant = 'premium' if is_premium else 'free'
+                media['file_path'] = await self.derive_variant(media['file_path'], variant)
+            
+            return media
+            
+        except MediaRejected:
+            raise
+        except Exception as e:
+            logger.error(f"Download error: {e}")
+            return None
+
+    async def resolve_source(self, query, search_query, media_type, priority, is_premium=False):
+        """Cached or freshly fetched source for a URL or text search, before any tier variant"""
+        cached_url = self.lookup_search_cache(query, media_type) if search_query != query else None
         
-        with yt_dlp.YoutubeDL(ytdl_opts) as ytdl:
+        media = self.lookup_media_cache(cached_url or search_query, media_type)
+        if priority != PRIORITY_PREFETCH:
+            self.record_cache_lookup(media is not None)
+        if media is not None:
+            self.check_admission(media, is_premium)
+            if media['loudness_gain'] is None:
+                self.schedule_loudness(media, media_type)
+            return media
+        
+        if cached_url:
             try:
-                # Search if not a direct URL
-                if not (query.startswith('http://') or query.startswith('https://')):
-                    search_query = f"ytsearch1:{query}"
-                else:
-                    search_query = query
-                
-                info = ytdl.extract_info(search_query, download=True)
-                
-                if 'entries' in info and info['entries']:
-                    info = info['entries'][0]
-                
-                # Get the downloaded file path
-                file_path = ytdl.prepare_filename(info)
-                
-                return {
-                    'title': info.get('title', 'Unknown'),
-                    'duration': info.get('duration', 0),
-                    'file_path': file_path,
-                    'webpage_url': info.get('webpage_url'),
-                    'thumbnail': info.get('thumbnail'),
-                    'uploader': info.get('uploader', 'Unknown'),
-                    'view_count': info.get('view_count', 0)
-                }
-                
+                return await self.fetch_source(cached_url, media_type, priority, is_premium)
+            except SourceUnavailable:
+                pass  # the text search below can still go to the fallback source
+            except MediaRejected:
+                raise
             except Exception as e:
-                logger.error(f"Download error: {e}")
-                return None
+                # Removed or private since it was cached: search again instead of failing until the row expires
+                logger.info(f"Cached result for {query!r} failed ({e}), searching again")
+                self.forget_search_cache(query, media_type)
+        
+        media = await self.fetch_source(search_query, media_type, priority, is_premium)
+        # Fallback results aren't remembered, so the query goes back to the primary source once it recovers
+        if search_query != query and media.get('webpage_url') and self.source_of(media['webpage_url']) == self.source_of(search_query):
+            self.store_search_cache(query, media_type, media['webpage_url'])
+        return media
+
+    def check_admission(self, info, is_premium):
+        """Raise MediaRejected if resolved metadata exceeds the tier's limits"""
+        tier = 'premium' if is_premium else 'free'
+        limits = self.admission_limits[tier]
+        
+        if info.get('live_status') == 'is_upcoming':
+            raise MediaRejected("This stream has not started yet")
+        if self.is_live_info(info):
+            if not self.allow_live_streams:
+                raise MediaRejected("Live streams are not supported")
+            return  # streamed directly, nothing is downloaded
+        
+        duration = info.get('duration') or 0
+        if duration > limits['duration']:
+            raise MediaRejected(
+                f"Too long: {duration // 60} min (limit {limits['duration'] // 60} min for {tier} users)"
+            )
+        
+        size = self.estimate_size(info)
+        if size > limits['filesize']:
+            raise MediaRejected(
+                f"Too large: ~{size // (1024 * 1024)} MB (limit {limits['filesize'] // (1024 * 1024)} MB for {tier} users)"
+            )
+
+    @tracer.traced('library.search')
+    def library_media(self, query):
+        """Media entry for the best local library match, if any"""
+        matches = self.library.search(query)
+        if not matches:
+            return None
+        
+        match = matches[0]
+        title = f"{match['artist']} - {match['title']}" if match['artist'] else match['title']
+        return self.local_file_media(match['path'], title, match['artist'], match['duration'])
+
+    def local_file_media(self, path, title=None, artist=None, duration=0):
+        """Media entry for a file on local disk, or None if it is gone"""
+        if not os.path.exists(path):
+            return None
+        return {
+            'track_id': f"local-{hashlib.sha1(path.encode()).hexdigest()[:16]}",
+            'title': title or Path(path).stem,
+            'duration': duration,
+            'file_path': path,
+            'webpage_url': Path(path).as_uri(),
+            'thumbnail': None,
+            'uploader': artist or 'Local library',
+            'view_count': 0,
+            'is_local': True
+        }
+
+    def is_live_info(self, info):
+        return bool(info.get('is_live')) or info.get('live_status') == 'is_live'
+
+    def live_media(self, stream_url, title, webpage_url, http_headers=None, resolve_url=None, **extra):
+        """Media entry for an endless source that is piped, never downloaded"""
+        return {
+            'track_id': f"live-{hashlib.sha1(webpage_url.encode()).hexdigest()[:16]}",
+            'title': title,
+            'duration': 0,
+            'file_path': None,
+            'is_live': True,
+            'stream_url': stream_url,
+            'http_headers': http_headers or {},
+            'resolve_url': resolve_url,  # re-resolved on reconnect when signed URLs expire
+            'webpage_url': webpage_url,
+            'thumbnail': extra.get('thumbnail'),
+            'uploader': extra.get('uploader', 'Unknown'),
+            'view_count': extra.get('view_count', 0)
+        }
+
+    @tracer.traced('radio_probe')
+    async def probe_radio_stream(self, url):
+        """Return live media if url is an endless HTTP audio stream (Icecast/Shoutcast)"""
+        import aiohttp
+        
+        host = urlparse(url).hostname or ''
+        if host.endswith(('youtube.com', 'youtu.be')):
+            return None
+        
+        try:
+            async with self.ranged_downloader.session.get(
+                url, headers={'Icy-MetaData': '1'}, timeout=aiohttp.ClientTimeout(total=5)
+            ) as resp:
+                content_type = resp.headers.get('Content-Type', '')
+                is_icecast = any(header.lower().startswith('icy-') for header in resp.headers)
+                is_endless_audio = resp.content_length is None and (
+                    content_type.startswith('audio/') or content_type == 'application/ogg'
+                )
+                if not (is_icecast or is_endless_audio):
+                    return None
+                return self.live_media(url, resp.headers.get('icy-name') or url, url)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return None
+
+    def estimate_size(self, info):
+        """Best-effort download size in bytes from resolved metadata"""
+        formats = info.get('requested_formats') or [info]
+        size = 0
+        for fmt in formats:
+            fmt_size = fmt.get('filesize') or fmt.get('filesize_approx')
+            if not fmt_size and fmt.get('tbr') and info.get('duration'):
+                fmt_size = fmt['tbr'] * 1024 / 8 * info['duration']
+            size += int(fmt_size or 0)
+        return size
+
+    async def fetch_source(self, search_query, media_type, priority, is_premium=False):
+        """Resolve a query, check admission, then download its source once"""
+        # Metadata resolution does not wait behind running downloads
+        info, file_path = await self.resolve_info(search_query, media_type)
+        self.check_admission(info, is_premium)
+        
+        if self.is_live_info(info):
+            return self.live_media(
+                info['url'], info.get('title', 'Unknown'), info.get('webpage_url') or search_query,
+                http_headers=info.get('http_headers'),
+                resolve_url=info.get('webpage_url'),
+                thumbnail=info.get('thumbnail'),
+                uploader=info.get('uploader', 'Unknown'),
+                view_count=info.get('concurrent_view_count') or info.get('view_count', 0)
+            )
+        
+        if not os.path.exists(file_path):
+            download = self.inflight_downloads.get(file_path)
+            if download is None:
+                max_bytes = self.admission_limits['premium' if is_premium else 'free']['filesize']
+                download = asyncio.ensure_future(self._download_source(info, file_path, media_type, priority, max_bytes))
+                self.inflight_downloads[file_path] = download
+                download.add_done_callback(lambda _: self.inflight_downloads.pop(file_path, None))
+            await asyncio.shield(download)
+        
+        media = {
+            'track_id': f"{info.get('extractor', 'generic')}-{info.get('id')}",
+            'title': info.get('title', 'Unknown'),
+            'duration': info.get('duration', 0),
+            'file_path': file_path,
+            'webpage_url': info.get('webpage_url'),
+            'thumbnail': info.get('thumbnail'),
+            'uploader': info.get('uploader', 'Unknown'),
+            'view_count': info.get('view_count', 0),
+            'loudness_gain': None
+        }
+        self.store_media_cache(media, media_type)
+        self.schedule_loudness(media, media_type)
+        return media
+
+    def source_of(self, query):
+        """Health-tracking key for a search query or URL"""
+        prefix = re.match(r'([a-z]+search)\d*:', query)
+        if prefix:
+            return SEARCH_SOURCES.get(prefix.group(1), prefix.group(1))
+        
+        host = (urlparse(query).hostname or 'generic').split('.')
+        name = host[-2] if len(host) > 1 else host[0]
+        return 'youtube' if name == 'youtu' else name
+
+    def source_breaker(self, source):
+        breaker = self.source_breakers.get(source)
+        if breaker is None:
+            breaker = self.source_breakers[source] = CircuitBreaker(
+                source, failure_threshold=self.breaker_threshold, reset_timeout=self.breaker_reset
+            )
+        return breaker
+
+    def fallback_query(self, search_query, media_type):
+        """Same search on the fallback source, if there is one for this query"""
+        search = re.match(r'([a-z]+search)\d*:(.*)', search_query, re.S)
+        if not search or not self.fallback_search or media_type != 'audio' or search.group(1) == self.fallback_search:
+            return None
+        return f"{self.fallback_search}1:{search.group(2)}"
+
+    @tracer.traced('extract')
+    async def resolve_info(self, search_query, media_type):
+        """Extract metadata through the source's circuit breaker, falling back to another source for searches"""
+        source = self.source_of(search_query)
+        breaker = self.source_breaker(source)
+        fallback = self.fallback_query(search_query, media_type)
+        
+        if not breaker.allow():
+            if fallback:
+                return await self.resolve_info(fallback, media_type)
+            raise SourceUnavailable(f"{source.title()} is unavailable right now, try again in {int(breaker.retry_in) + 1}s")
+        
+        try:
+            result = await self.extract(search_query, media_type)
+        except Exception as e:
+            if self.is_source_outage(e):
+                breaker.record_failure('timed out' if isinstance(e, asyncio.TimeoutError) else e)
+            else:
+                breaker.record_success()  # the source answered, this video or query is the problem
+            if fallback:
+                logger.info(f"Falling back from {source} for {search_query!r}")
+                return await self.resolve_info(fallback, media_type)
+            raise
+        finally:
+            breaker.probing = False
+        
+        breaker.record_success()
+        return result
+
+    async def extract(self, search_query, media_type):
+        """Run _extract_sync on the extraction threads, giving up after extract_timeout"""
+        return await asyncio.wait_for(
+            asyncio.get_running_loop().run_in_executor(self.extract_executor, self._extract_sync, search_query, media_type),
+            self.extract_timeout
+        )
+
+    def is_source_outage(self, error):
+        """Whether an extraction error means the source is failing, rather than one video or query"""
+        if isinstance(error, asyncio.TimeoutError):
+            return True
+        
+        from yt_dlp.utils import DownloadError, ExtractorError
+        if not isinstance(error, DownloadError):
+            return False
+        
+        cause = error.exc_info[1] if error.exc_info else None
+        if isinstance(cause, ExtractorError) and cause.cause is not None:
+            cause = cause.cause
+        status = getattr(cause, 'status', None) or getattr(cause, 'code', None)
+        if isinstance(status, int):
+            return status == 429 or status >= 500
+        if re.search(r'HTTP Error (429|5\d\d)', str(error)):
+            return True
+        if isinstance(cause, ExtractorError):
+            # Unavailable, private, geo-blocked and similar errors are raised as expected
+            return not cause.expected
+        return isinstance(cause, (OSError, http.client.HTTPException))
+
+    async def probe_sources(self):
+        """Background task test-searching unavailable sources so they recover without user traffic"""
+        prefixes = {source: prefix for prefix, source in SEARCH_SOURCES.items()}
+        while True:
+            await asyncio.sleep(max(5, self.breaker_reset // 4))
+            for source, breaker in list(self.source_breakers.items()):
+                if source not in prefixes or breaker.state == 'closed' or breaker.retry_in or not breaker.allow():
+                    continue
+                
+                try:
+                    await self.extract(f"{prefixes[source]}1:{self.source_probe_query}", 'audio')
+                    breaker.record_success()
+                except Exception as e:
+                    if self.is_source_outage(e):
+                        breaker.record_failure('timed out' if isinstance(e, asyncio.TimeoutError) else e)
+                    else:
+                        breaker.record_success()
+
+    @tracer.traced('download')
+    async def _download_source(self, info, file_path, media_type, priority, max_bytes=None):
+        async with self.download_scheduler.slot(priority):
+            if self.is_direct_download(info):
+                await self.ranged_downloader.download(
+                    info['url'], file_path,
+                    headers=info.get('http_headers'),
+                    throttle=partial(self.download_scheduler.throttle, priority),
+                    max_bytes=max_bytes
+                )
+            else:
+                await self.download_scheduler.run_in_thread(
+                    priority, self._process_sync, info, media_type
+                )
+
+    @tracer.traced('cache.lookup')
+    def lookup_media_cache(self, query, media_type):
+        """Return cached media for a URL whose source is still on disk"""
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT track_id, title, duration, webpage_url, thumbnail, uploader, view_count, file_path, loudness_gain
+            FROM media_cache WHERE webpage_url = ? AND media_type = ?
+        ''', (query, media_type))
+        
+        row = cursor.fetchone()
+        if not row or not os.path.exists(row[7]):
+            return None
+        
+        keys = ('track_id', 'title', 'duration', 'webpage_url', 'thumbnail', 'uploader', 'view_count', 'file_path', 'loudness_gain')
+        return dict(zip(keys, row))
+
+    @staticmethod
+    def search_key(query):
+        return ' '.join(query.lower().split())
+
+    def lookup_search_cache(self, query, media_type):
+        """URL a text search resolved to recently, if any"""
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT webpage_url FROM search_cache
+            WHERE query = ? AND media_type = ? AND cached_at >= datetime('now', ?)
+        ''', (self.search_key(query), media_type, f'-{self.search_cache_days} days'))
+        
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    def store_search_cache(self, query, media_type, webpage_url):
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            INSERT OR REPLACE INTO search_cache (query, media_type, webpage_url)
+            VALUES (?, ?, ?)
+        ''', (self.search_key(query), media_type, webpage_url))
+        self.conn.commit()
+
+    def forget_search_cache(self, query, media_type):
+        cursor = self.conn.cursor()
+        cursor.execute('DELETE FROM search_cache WHERE query = ? AND media_type = ?', (self.search_key(query), media_type))
+        self.conn.commit()
+
+    def record_cache_lookup(self, hit):
+        outcome = 'hits' if hit else 'misses'
+        self.cache_lookups[outcome] += 1
+        if time.monotonic() < self.cold_start_until:
+            self.cache_lookups[f'cold_start_{outcome}'] += 1
 
-    async def play_next_in_queue(self, chat_id):
+    @tracer.traced('db.media_cache')
+    def store_media_cache(self, media, media_type):
+        """Record a fetched source in the media cache index"""
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            INSERT OR REPLACE INTO media_cache
+            (track_id, media_type, title, duration, webpage_url, thumbnail, uploader, view_count, file_path, loudness_gain)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (
+            media['track_id'], media_type, media['title'], media['duration'], media['webpage_url'],
+            media['thumbnail'], media['uploader'], media['view_count'], media['file_path'], media.get('loudness_gain')
+        ))
+        self.conn.commit()
+
+    def schedule_loudness(self, media, media_type):
+        """Measure a newly cached source's loudness in the background, once per track"""
+        if not self.normalize_loudness or media['track_id'] in self.inflight_loudness:
+            return
+        task = asyncio.ensure_future(self.analyze_loudness(media, media['file_path'], media_type))
+        self.inflight_loudness[media['track_id']] = task
+        task.add_done_callback(lambda _: self.inflight_loudness.pop(media['track_id'], None))
+
+    async def analyze_loudness(self, media, source_path, media_type):
+        try:
+            gain = await self.measure_loudness(source_path)
+        except Exception as e:
+            logger.warning(f"Loudness analysis failed for {media['title']}: {e}")
+            return
+        
+        # Queued items share this dict and pick the gain up on their next build_stream
+        media['loudness_gain'] = gain
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            UPDATE media_cache SET loudness_gain = ? WHERE track_id = ? AND media_type = ?
+        ''', (gain, media['track_id'], media_type))
+        self.conn.commit()
+
+    async def measure_loudness(self, source_path):
+        """Gain in dB bringing a file to the loudness target without pushing peaks past -1 dBTP"""
+        async with self.transcode_semaphore:
+            process = await asyncio.create_subprocess_exec(
+                'ffmpeg', '-hide_banner', '-nostats', '-i', source_path, '-vn',
+                '-af', f'loudnorm=I={self.loudness_target}:TP=-1:print_format=json', '-f', 'null', '-',
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE
+            )
+            _, stderr = await process.communicate()
+        
+        if process.returncode != 0:
+            raise RuntimeError(f"ffmpeg exited with {process.returncode}")
+        output = stderr.decode(errors='ignore')
+        measured = json.loads(output[output.rindex('{'):output.rindex('}') + 1])
+        
+        integrated, true_peak = float(measured['input_i']), float(measured['input_tp'])
+        if integrated == float('-inf'):
+            return 0.0  # silence
+        return round(max(-20.0, min(self.loudness_target - integrated, -1.0 - true_peak)), 1)
+
+    @tracer.traced('variant')
+    async def derive_variant(self, source_path, variant):
+        """Return the path of a lower-bitrate variant, transcoding it on first use"""
+        ffmpeg_args = AUDIO_VARIANTS.get(variant)
+        if ffmpeg_args is None:
+            return source_path
+        
+        variant_path = str(Path(source_path).with_suffix(f'.{variant}.opus'))
+        if not os.path.exists(variant_path):
+            await self.transcode(source_path, variant_path, ffmpeg_args)
+        return variant_path
+
+    async def transcode(self, source_path, output_path, ffmpeg_args):
+        """Run one ffmpeg job in the transcode pool, sharing identical in-flight jobs"""
+        job = self.inflight_transcodes.get(output_path)
+        if job is None:
+            job = asyncio.ensure_future(self._run_ffmpeg(source_path, output_path, ffmpeg_args))
+            self.inflight_transcodes[output_path] = job
+            job.add_done_callback(lambda _: self.inflight_transcodes.pop(output_path, None))
+        await asyncio.shield(job)
+
+    @tracer.traced('ffmpeg')
+    async def _run_ffmpeg(self, source_path, output_path, ffmpeg_args):
+        # Write under a temporary name so readers never see a partial file
+        tmp_path = f"{output_path}.tmp{Path(output_path).suffix}"
+        async with self.transcode_semaphore:
+            process = await asyncio.create_subprocess_exec(
+                'ffmpeg', '-y', '-hide_banner', '-loglevel', 'error',
+                '-i', source_path, *ffmpeg_args, tmp_path,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE
+            )
+            _, stderr = await process.communicate()
+        
+        if process.returncode != 0:
+            Path(tmp_path).unlink(missing_ok=True)
+            raise RuntimeError(f"ffmpeg failed for {source_path}: {stderr.decode(errors='ignore').strip()}")
+        os.replace(tmp_path, output_path)
+
+    def is_direct_download(self, info):
+        """Whether the resolved format is a single plain HTTP(S) file"""
+        return (
+            info.get('protocol') in ('http', 'https')
+            and bool(info.get('url'))
+            and not info.get('requested_formats')
+        )
+
+    def _extract_sync(self, search_query, media_type):
+        """Resolve metadata and the media URL without downloading"""
+        with self.extractor_pool.acquire(media_type, self.ytdl_options(media_type)) as ytdl:
+            info = ytdl.extract_info(search_query, download=False)
+            
+            if 'entries' in info and info['entries']:
+                info = info['entries'][0]
+            
+            return info, ytdl.prepare_filename(info)
+
+    def _process_sync(self, info, media_type):
+        """Download already-resolved media with yt-dlp's own downloaders"""
+        with self.extractor_pool.acquire(media_type, self.ytdl_options(media_type)) as ytdl:
+            ytdl.process_ie_result(info, download=True)
+
+    @chat_serialized
+    @tracer.traced('play_next')
+    async def play_next_in_queue(self, chat_id, autoplay=True):
         """Play next song in queue using PyTgCalls"""
+        from pytgcalls import StreamType
+        from pytgcalls.exceptions import NoActiveGroupCall
+        
+        self.playback_positions.pop(chat_id, None)
+        self.touch_chat(chat_id)
+        if not self.queue.get(chat_id) and autoplay and chat_id in self.autoplay_chats and chat_id in self.current_playing:
+            # The pick may still be downloading; resolve it off the actor so /skip and /stop stay responsive
+            asyncio.create_task(self.continue_autoplay(chat_id, self.current_playing[chat_id]))
+            return
+        
         if chat_id not in self.queue or not self.queue[chat_id]:
             if chat_id in self.current_playing:
                 del self.current_playing[chat_id]
+                self.queue_changed(chat_id)
+            self.governor.stream_paths.pop(chat_id, None)
             return
         
         next_item = self.queue[chat_id].pop(0)
         self.current_playing[chat_id] = next_item
+        self.queue_changed(chat_id)
+        self.refresh_pins(chat_id)
+        
+        if self.draining:
+            return  # checkpointed at position 0 for the next instance
         
         try:
-            file_path = next_item['info']['file_path']
+            await self.governor.wait_for_capacity(self.join_wait_seconds)
+            stream = await self.build_stream(next_item)
             
-            if next_item['type'] == 'audio':
-                # Audio stream
-                audio_quality = HighQualityAudio() if await self.is_premium_user(next_item['user_id']) else None
-                stream = AudioPiped(file_path, audio_parameters=audio_quality)
-            else:
-                # Video stream  
-                video_quality = HighQualityVideo()
-                audio_quality = HighQualityAudio()
-                stream = AudioVideoPiped(file_path, audio_parameters=audio_quality, video_parameters=video_quality)
-            
-            await self.call_py.join_group_call(
-                chat_id,
-                stream,
-                stream_type=StreamType().pulse_stream
-            )
+            with tracer.span('join_group_call'):
+                await self.call_py.join_group_call(
+                    chat_id,
+                    stream,
+                    stream_type=StreamType().pulse_stream
+                )
+            self.track_position(chat_id, 0)
             
             # Log to history
             await self.log_song_history(next_item)
             
+            if chat_id in self.autoplay_chats and not self.queue[chat_id]:
+                self.prefetch_autoplay(chat_id, next_item)
+            
         except NoActiveGroupCall:
             logger.warning(f"No active voice chat in {chat_id}")
-            # Try to play next song
-            await self.play_next_in_queue(chat_id)
+            # Try to play next song; autoplay only continues after a successful play
+            await self.play_next_in_queue(chat_id, autoplay=False)
         except Exception as e:
             logger.error(f"Error playing media: {e}")
             # Try to play next song
+            await self.play_next_in_queue(chat_id, autoplay=False)
+
+    @tracer.traced('build_stream')
+    async def build_stream(self, item, position=0):
+        """Build the PyTgCalls input stream for a queue item, starting at position seconds"""
+        from pytgcalls.types.input_stream import AudioPiped, AudioVideoPiped
+        from pytgcalls.types.input_stream.quality import (
+            HighQualityAudio, HighQualityVideo, LowQualityAudio,
+            LowQualityVideo, MediumQualityAudio, MediumQualityVideo
+        )
+        
+        info = item['info']
+        if info.get('is_live'):
+            path = info['stream_url']
+            headers = info.get('http_headers') or None
+            ffmpeg_parameters = LIVE_FFMPEG_PARAMETERS
+        else:
+            path = self.media_store.resolve(item.get('effect_path') or info['file_path'])
+            headers = None
+            # Input-side seek on the cached file, no refetch
+            ffmpeg_parameters = f'-ss {position}' if position else ''
+            # Precomputed static gain, applied after the input
+            if item['type'] == 'audio' and info.get('loudness_gain'):
+                ffmpeg_parameters = f"{ffmpeg_parameters} -atmid -af volume={info['loudness_gain']}dB".strip()
+        
+        chat_id = item['chat_id']
+        level = self.governor.level(chat_id)
+        self.governor.stream_paths[chat_id] = path
+        
+        if item['type'] == 'audio':
+            # Audio stream
+            if level:
+                audio_quality = (MediumQualityAudio, LowQualityAudio)[level - 1]()
+            else:
+                audio_quality = HighQualityAudio() if await self.is_premium_user(item['user_id']) else None
+            return AudioPiped(
+                path, audio_parameters=audio_quality,
+                headers=headers, additional_ffmpeg_parameters=ffmpeg_parameters
+            )
+        
+        # Video stream
+        video_quality = (HighQualityVideo, MediumQualityVideo, LowQualityVideo)[level]()
+        audio_quality = (HighQualityAudio, MediumQualityAudio, LowQualityAudio)[level]()
+        return AudioVideoPiped(
+            path, audio_parameters=audio_quality, video_parameters=video_quality,
+            headers=headers, additional_ffmpeg_parameters=ffmpeg_parameters
+        )
+
+    async def govern_streams(self):
+        """Background task sampling CPU and re-encoding one stream at a time at a new quality"""
+        await asyncio.to_thread(self.governor.sample)  # baseline for cpu_percent
+        while True:
+            await asyncio.sleep(5)
+            try:
+                await asyncio.to_thread(self.governor.sample)
+                change = self.governor.plan()
+                if change:
+                    await self.apply_quality(*change)
+            except Exception as e:
+                logger.error(f"Resource governor error: {e}")
+
+    @chat_serialized
+    async def apply_quality(self, chat_id, level):
+        """Restart the chat's stream at level, continuing from the current position"""
+        previous = self.governor.level(chat_id)
+        self.governor.levels[chat_id] = level
+        item = self.current_playing.get(chat_id)
+        if not item:
+            return
+        
+        if chat_id in self.playback_positions and self.playback_positions[chat_id]['started_at'] is None:
+            return  # paused, picked up by the next join or change_stream
+        
+        position = 0 if item['info'].get('is_live') else int(self.current_position(chat_id))
+        try:
+            await self.call_py.change_stream(chat_id, await self.build_stream(item, position))
+        except Exception as e:
+            self.governor.levels[chat_id] = previous
+            logger.warning(f"Could not change quality in {chat_id}: {e}")
+            return
+        
+        self.track_position(chat_id, position)
+        logger.info(f"Stream quality in {chat_id}: {QUALITY_LEVELS[previous]} -> {QUALITY_LEVELS[level]} "
+                    f"(host CPU {self.governor.host_cpu:.0f}%)")
+
+    def track_position(self, chat_id, offset, paused=False):
+        """Record that playback in chat_id is at offset seconds"""
+        self.playback_positions[chat_id] = {
+            'offset': offset,
+            'started_at': None if paused else time.monotonic()
+        }
+
+    def current_position(self, chat_id):
+        """Seconds into the current track, or 0 if untracked"""
+        state = self.playback_positions.get(chat_id)
+        if not state:
+            return 0
+        if state['started_at'] is None:
+            return state['offset']
+        return state['offset'] + time.monotonic() - state['started_at']
+
+    async def reconnect_live(self, chat_id, item):
+        """Restart a dropped live stream with exponential backoff"""
+        for attempt in range(self.live_max_reconnects):
+            await asyncio.sleep(min(2 ** attempt, 60))
+            if self.current_playing.get(chat_id) is not item:
+                return  # skipped or stopped meanwhile
+            
+            try:
+                if item['info'].get('resolve_url'):
+                    info, _ = await self.extract(item['info']['resolve_url'], item['type'])
+                    item['info']['stream_url'] = info['url']
+                    item['info']['http_headers'] = info.get('http_headers') or {}
+                
+                if await self.restart_live_stream(chat_id, item):
+                    logger.info(f"Reconnected live stream in {chat_id} after {attempt + 1} attempt(s)")
+                return
+            except Exception as e:
+                logger.warning(f"Live reconnect attempt {attempt + 1} failed in {chat_id}: {e}")
+        
+        logger.error(f"Giving up on live stream in {chat_id}")
+        await self.abandon_live_stream(chat_id, item)
+
+    @chat_serialized
+    async def restart_live_stream(self, chat_id, item):
+        if self.current_playing.get(chat_id) is not item:
+            return False
+        await self.call_py.change_stream(chat_id, await self.build_stream(item))
+        return True
+
+    @chat_serialized
+    async def abandon_live_stream(self, chat_id, item):
+        if self.current_playing.get(chat_id) is item:
             await self.play_next_in_queue(chat_id)
 
+    def autoplay_candidate(self, chat_id):
+        """Strongest co-play neighbour of the chat's recent tracks that it has not just heard"""
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT song_url FROM song_history WHERE chat_id = ? ORDER BY id DESC LIMIT 20
+        ''', (chat_id,))
+        recent = [row[0] for row in cursor.fetchall() if row[0]]
+        if not recent:
+            return None
+        
+        sources = recent[:3]
+        cursor.execute(f'''
+            SELECT dst_url, dst_title, SUM(weight) AS score FROM coplay_edges
+            WHERE src_url IN ({','.join('?' * len(sources))})
+              AND dst_url NOT IN ({','.join('?' * len(recent))})
+            GROUP BY dst_url
+            ORDER BY score DESC, MAX(last_played) DESC
+            LIMIT 1
+        ''', (*sources, *recent))
+        return cursor.fetchone()
+
+    def prefetch_autoplay(self, chat_id, current_item):
+        """Resolve and download the autoplay pick while the current track plays"""
+        if current_item['info'].get('is_live'):
+            return
+        source_url = current_item['info'].get('webpage_url')
+        pending = self.autoplay_next.get(chat_id)
+        if pending and pending[0] == source_url:
+            return
+        
+        if pending:
+            pending[1].cancel()
+        self.autoplay_next[chat_id] = (source_url, asyncio.create_task(self.resolve_autoplay(chat_id, current_item)))
+
+    async def resolve_autoplay(self, chat_id, current_item):
+        candidate = self.autoplay_candidate(chat_id)
+        if not candidate:
+            return None
+        
+        url, title, _ = candidate
+        is_premium = await self.is_premium_user(current_item['user_id'])
+        try:
+            media = await self.download_media(url, is_premium, media_type='audio', priority=PRIORITY_PREFETCH)
+        except MediaRejected as e:
+            logger.info(f"Autoplay skipped {title}: {e}")
+            return None
+        if not media:
+            return None
+        
+        return {
+            'info': media,
+            'requested_by': "📻 Autoplay",
+            'user_id': current_item['user_id'],
+            'type': 'audio',
+            'chat_id': chat_id
+        }
+
+    async def continue_autoplay(self, chat_id, ended):
+        item = await self.next_autoplay_item(chat_id)
+        await self.play_autoplay_item(chat_id, ended, item)
+
+    @chat_serialized
+    async def play_autoplay_item(self, chat_id, ended, item):
+        if self.current_playing.get(chat_id) is not ended:
+            return  # skipped or stopped while the pick was resolving
+        
+        if item and not self.queue.get(chat_id):
+            self.queue.setdefault(chat_id, []).append(item)
+            self.queue_changed(chat_id)
+        await self.play_next_in_queue(chat_id, autoplay=False)
+
+    async def next_autoplay_item(self, chat_id):
+        """Queue item to continue an autoplay chat with, using the pre-resolved pick when fresh"""
+        current = self.current_playing.get(chat_id)
+        if chat_id not in self.autoplay_chats or not current:
+            return None
+        
+        pending = self.autoplay_next.pop(chat_id, None)
+        if not pending or pending[0] != current['info'].get('webpage_url'):
+            if pending:
+                pending[1].cancel()
+            pending = (None, asyncio.ensure_future(self.resolve_autoplay(chat_id, current)))
+        
+        try:
+            return await pending[1]
+        except asyncio.CancelledError:
+            return None
+        except Exception as e:
+            logger.error(f"Autoplay error in {chat_id}: {e}")
+            return None
+
+    @traced_command
+    @chat_serialized
+    async def handle_autoplay(self, event):
+        """Toggle autoplay radio mode for the chat"""
+        if not await self.check_permissions(event):
+            return
+        
+        chat_id = event.chat_id
+        message_parts = event.message.message.split()
+        mode = message_parts[1].lower() if len(message_parts) > 1 else ('off' if chat_id in self.autoplay_chats else 'on')
+        
+        if mode not in ('on', 'off'):
+            await event.respond("❌ **Usage:** `/autoplay [on|off]`")
+            return
+        
+        if mode == 'on':
+            self.autoplay_chats.add(chat_id)
+            self.touch_chat(chat_id)  # released by the idle reaper if nothing is ever played
+            if chat_id in self.current_playing and not self.queue.get(chat_id):
+                self.prefetch_autoplay(chat_id, self.current_playing[chat_id])
+            await event.respond("📻 **Autoplay on** - I'll keep the music going when the queue runs out")
+        else:
+            self.autoplay_chats.discard(chat_id)
+            pending = self.autoplay_next.pop(chat_id, None)
+            if pending:
+                pending[1].cancel()
+            await event.respond("📻 **Autoplay off**")
+
+    def refresh_pins(self, chat_id):
+        """Keep the chat's current and next-up files pinned in the hot tier"""
+        items = []
+        if chat_id in self.current_playing:
+            items.append(self.current_playing[chat_id])
+        items.extend(self.queue.get(chat_id, [])[:1])
+        
+        if items:
+            self.media_store.pin(chat_id, [item.get('effect_path') or item['info'].get('file_path') for item in items])
+        else:
+            self.media_store.unpin(chat_id)
+
+    @traced_command
     async def on_stream_end(self, update):
         """Handle stream end event"""
-        chat_id = update.chat_id
+        # Bind the event to the track playing when it fired
+        await self.advance_after_stream_end(update.chat_id, self.current_playing.get(update.chat_id))
+
+    @chat_serialized
+    async def advance_after_stream_end(self, chat_id, ended):
+        current = self.current_playing.get(chat_id)
+        if current is not ended:
+            return  # a skip or stop already moved past the ended track
+        
+        # Live items have no end; a finished stream means the connection dropped
+        if current and current['info'].get('is_live'):
+            asyncio.create_task(self.reconnect_live(chat_id, current))
+            return
+        
         await self.play_next_in_queue(chat_id)
 
+    @traced_command
     async def handle_queue(self, event):
         """Show current queue"""
-        chat_id = event.chat_id
+        message_parts = event.message.message.split()
+        page = int(message_parts[1]) - 1 if len(message_parts) > 1 and message_parts[1].isdigit() else 0
         
-        if chat_id not in self.queue or not self.queue[chat_id]:
+        text, buttons = self.render_queue_page(event.chat_id, page)
+        await event.respond(text, buttons=buttons)
+
+    async def handle_queue_page(self, event):
+        """Flip the /queue message to another page in place"""
+        page = int(event.data_match.group(1))
+        text, buttons = self.render_queue_page(event.chat_id, page)
+        
+        try:
+            await event.edit(text, buttons=buttons)
+        except MessageNotModifiedError:
+            pass
+        await event.answer()
+
+    def queue_changed(self, chat_id):
+        self.queue_versions[chat_id] += 1
+
+    def render_queue_page(self, chat_id, page):
+        """Queue page text and navigation buttons, cached until the queue changes"""
+        queue_items = self.queue.get(chat_id, [])
+        page_count = max(1, -(-len(queue_items) // self.queue_page_size))
+        page = min(max(page, 0), page_count - 1)
+        
+        version = self.queue_versions[chat_id]
+        cached = self.queue_pages.get((chat_id, page))
+        if cached and cached[0] == version:
+            return cached[1], cached[2]
+        
+        buttons = None
+        if not queue_items:
             if chat_id in self.current_playing:
                 current = self.current_playing[chat_id]
-                msg = f"🎵 **Currently Playing:**\n**{current['info']['title']}**\n👤 {current['requested_by']}\n\n📭 **Queue is empty**"
+                queue_msg = f"🎵 **Currently Playing:**\n**{current['info']['title']}**\n👤 {current['requested_by']}\n\n📭 **Queue is empty**"
             else:
-                msg = "📭 **Nothing is playing and queue is empty**"
-            await event.respond(msg)
-            return
-        
-        queue_msg = "🎵 **Music Queue:**\n\n"
-        
-        # Current playing
-        if chat_id in self.current_playing:
-            current = self.current_playing[chat_id]
-            media_icon = "🎥" if current['type'] == 'video' else "🎵"
-            queue_msg += f"{media_icon} **Now Playing:** {current['info']['title']}\n👤 {current['requested_by']}\n\n"
-        
-        # Queue items
-        queue_msg += "**📝 Up Next:**\n"
-        for i, item in enumerate(self.queue[chat_id][:10], 1):
-            media_icon = "🎥" if item['type'] == 'video' else "🎵"
-            queue_msg += f"{i}. {media_icon} **{item['info']['title']}**\n   👤 {item['requested_by']}\n\n"
-        
-        if len(self.queue[chat_id]) > 10:
-            remaining = len(self.queue[chat_id]) - 10
-            queue_msg += f"... and **{remaining}** more songs\n"
+                queue_msg = "📭 **Nothing is playing and queue is empty**"
+        else:
+            parts = ["🎵 **Music Queue:**\n\n"]
+            
+            # Current playing
+            if chat_id in self.current_playing:
+                current = self.current_playing[chat_id]
+                parts.append(f"{self.media_icon(current)} **Now Playing:** {current['info']['title']}\n👤 {current['requested_by']}\n\n")
+            
+            # Queue items
+            parts.append(f"**📝 Up Next ({len(queue_items)}):**\n")
+            start = page * self.queue_page_size
+            for i, item in enumerate(queue_items[start:start + self.queue_page_size], start + 1):
+                parts.append(f"{i}. {self.media_icon(item)} **{item['info']['title']}**\n   👤 {item['requested_by']}\n\n")
+            queue_msg = ''.join(parts)
+            
+            if page_count > 1:
+                buttons = [[
+                    Button.inline("⏮", b"queue:0"),
+                    Button.inline("◀️", f"queue:{max(page - 1, 0)}".encode()),
+                    Button.inline(f"{page + 1}/{page_count}", f"queue:{page}".encode()),
+                    Button.inline("▶️", f"queue:{min(page + 1, page_count - 1)}".encode()),
+                    Button.inline("⏭", f"queue:{page_count - 1}".encode()),
+                ]]
         
-        await event.respond(queue_msg)
+        # Chats without playback state are never reaped, so their pages aren't kept
+        if chat_id in self.last_activity:
+            self.queue_pages[(chat_id, page)] = (version, queue_msg, buttons)
+        return queue_msg, buttons
+
+    def media_icon(self, item):
+        if item['info'].get('is_live'):
+            return "🔴"
+        return "🎥" if item['type'] == 'video' else "🎵"
 
+    @traced_command
+    @chat_serialized
     async def handle_skip(self, event):
         """Skip current song"""
         chat_id = event.chat_id
@@ -523,26 +3039,296 @@ Join voice chat first, then use music commands!
         await self.play_next_in_queue(chat_id)
         await event.respond(f"⏭️ **Skipped:** {current_song}")
 
+    @traced_command
+    async def handle_stop(self, event):
+        """Stop music, clear the queue and leave the voice chat"""
+        if event.sender_id not in self.admin_users:
+            await event.respond("❌ **Only admins can stop the music!**")
+            return
+        
+        await self.release_chat(event.chat_id)
+        await event.respond("⏹️ **Music stopped and queue cleared!**")
+
+    async def dispatch(self, chat_id, func, *args):
+        """Run func on chat_id's actor and wait for its result"""
+        actor = self.chat_actors.get(chat_id)
+        if actor is None:
+            actor = self.chat_actors[chat_id] = ChatActor(chat_id)
+        if actor.task is not None and asyncio.current_task() is actor.task:
+            return await func(*args)  # already on this chat's actor
+        return await actor.submit(func, *args)
+
+    def prune_actors(self):
+        """Drop idle actors of chats that no longer have playback state"""
+        for chat_id, actor in list(self.chat_actors.items()):
+            if actor.task is None and chat_id not in self.last_activity:
+                self.actor_totals['processed'] += actor.processed
+                self.actor_totals['busy_ms'] += int(actor.busy_time * 1000)
+                del self.chat_actors[chat_id]
+
+    def touch_chat(self, chat_id):
+        self.last_activity[chat_id] = time.monotonic()
+
+    def is_chat_idle(self, chat_id, now):
+        """Nothing playing (queue ran dry or paused) for longer than the idle timeout"""
+        if chat_id in self.current_playing:
+            position = self.playback_positions.get(chat_id)
+            if not position or position['started_at'] is not None:
+                return False
+        return now - self.last_activity.get(chat_id, now) >= self.idle_timeout
+
+    async def reap_idle_chats(self):
+        """Background task leaving calls and dropping state for chats that went quiet"""
+        while True:
+            await asyncio.sleep(max(5, min(60, self.idle_timeout // 2)))
+            now = time.monotonic()
+            for chat_id in [chat_id for chat_id in self.last_activity if self.is_chat_idle(chat_id, now)]:
+                try:
+                    if await self.release_idle_chat(chat_id):
+                        logger.info(f"Released idle chat {chat_id}")
+                except Exception as e:
+                    logger.error(f"Error releasing idle chat {chat_id}: {e}")
+            self.prune_actors()
+
+    @chat_serialized
+    async def release_idle_chat(self, chat_id):
+        # Re-checked on the actor: a command may have arrived since the scan
+        if not self.is_chat_idle(chat_id, time.monotonic()):
+            return False
+        await self.release_chat(chat_id)
+        self.reaper_stats['idle_released'] += 1
+        return True
+
+    @chat_serialized
+    async def release_chat(self, chat_id):
+        """Leave the chat's call and drop every piece of per-chat state"""
+        try:
+            await self.call_py.leave_group_call(chat_id)
+            self.reaper_stats['calls_left'] += 1
+        except Exception:
+            pass  # not in a call
+        
+        pending = self.autoplay_next.pop(chat_id, None)
+        if pending:
+            pending[1].cancel()
+        
+        self.reaper_stats['queue_items_dropped'] += len(self.queue.pop(chat_id, []))
+        self.current_playing.pop(chat_id, None)
+        self.playback_positions.pop(chat_id, None)
+        self.last_activity.pop(chat_id, None)
+        self.autoplay_chats.discard(chat_id)
+        self.queue_versions.pop(chat_id, None)
+        for key in [key for key in self.queue_pages if key[0] == chat_id]:
+            del self.queue_pages[key]
+        self.media_store.unpin(chat_id)
+        self.governor.forget(chat_id)
+        self.reaper_stats['chats_released'] += 1
+
+    @traced_command
+    @chat_serialized
     async def handle_pause(self, event):
         """Pause current playback"""
         chat_id = event.chat_id
         
         try:
             await self.call_py.pause_stream(chat_id)
+            if chat_id in self.playback_positions:
+                self.track_position(chat_id, self.current_position(chat_id), paused=True)
+            self.touch_chat(chat_id)
             await event.respond("⏸️ **Music paused**")
         except Exception as e:
             await event.respond("❌ **Nothing is playing or failed to pause**")
 
+    @traced_command
+    @chat_serialized
     async def handle_resume(self, event):
         """Resume paused playback"""
         chat_id = event.chat_id
         
         try:
             await self.call_py.resume_stream(chat_id)
+            if chat_id in self.playback_positions:
+                self.track_position(chat_id, self.current_position(chat_id))
             await event.respond("▶️ **Music resumed**")
         except Exception as e:
-            await event.respond("❌ **Nothing is paused or failed to resume**")
+            if chat_id in self.current_playing and await self.rejoin_at_position(chat_id):
+                await event.respond(f"▶️ **Music resumed at {format_timestamp(self.current_position(chat_id))}**")
+            else:
+                await event.respond("❌ **Nothing is paused or failed to resume**")
+
+    async def rejoin_at_position(self, chat_id):
+        """Rejoin a dropped call and continue the current track where it stopped"""
+        from pytgcalls import StreamType
+        
+        item = self.current_playing[chat_id]
+        position = 0 if item['info'].get('is_live') else int(self.current_position(chat_id))
+        await self.governor.wait_for_capacity(self.join_wait_seconds)
+        try:
+            await self.call_py.join_group_call(
+                chat_id,
+                await self.build_stream(item, position),
+                stream_type=StreamType().pulse_stream
+            )
+        except Exception as e:
+            logger.error(f"Error rejoining call in {chat_id}: {e}")
+            return False
+        
+        self.track_position(chat_id, position)
+        return True
+
+    @traced_command
+    @chat_serialized
+    async def handle_seek(self, event):
+        """Seek within the current track using the cached file"""
+        chat_id = event.chat_id
+        message_parts = event.message.message.split()
+        
+        if chat_id not in self.current_playing:
+            await event.respond("❌ **Nothing is currently playing**")
+            return
+        
+        position = parse_timestamp(message_parts[1]) if len(message_parts) > 1 else None
+        if position is None:
+            await event.respond("❌ **Usage:** `/seek <mm:ss>`")
+            return
+        
+        item = self.current_playing[chat_id]
+        info = item['info']
+        if info.get('is_live'):
+            await event.respond("❌ **Live streams can't be seeked**")
+            return
+        duration = self.effective_duration(item)
+        if duration and position >= duration:
+            await event.respond(f"❌ **Track is only {format_timestamp(duration)} long**")
+            return
+        
+        try:
+            await self.call_py.change_stream(chat_id, await self.build_stream(item, position))
+        except Exception as e:
+            logger.error(f"Seek error: {e}")
+            await event.respond("❌ **Failed to seek**")
+            return
+        
+        self.track_position(chat_id, position)
+        await event.respond(f"⏩ **Seeked to {format_timestamp(position)}**")
+
+    def effect_speed(self, item):
+        return AUDIO_EFFECTS[item['effect']][2] if item.get('effect') else 1.0
+
+    def effective_duration(self, item):
+        """Playing time of an item's rendered file, in seconds"""
+        return (item['info'].get('duration') or 0) / self.effect_speed(item)
+
+    @traced_command
+    async def handle_effect(self, event):
+        """Apply a pre-rendered audio effect to the current or a queued track"""
+        if not await self.check_permissions(event):
+            return
+        
+        chat_id = event.chat_id
+        message_parts = event.message.message.split()
+        effect = message_parts[1].lower() if len(message_parts) > 1 else None
+        index = message_parts[2] if len(message_parts) > 2 else '0'
+        
+        if (effect not in AUDIO_EFFECTS and effect != 'off') or not index.isdigit():
+            effects = '\n'.join(f"• `{name}` - {label}" for name, (label, _, _) in AUDIO_EFFECTS.items())
+            await event.respond(f"🎛️ **Usage:** `/effect <name|off> [queue #]`\n\n{effects}")
+            return
+        
+        index = int(index)
+        if index == 0:
+            item = self.current_playing.get(chat_id)
+        else:
+            queue_items = self.queue.get(chat_id, [])
+            item = queue_items[index - 1] if index <= len(queue_items) else None
+        if not item:
+            await event.respond("❌ **No such track**")
+            return
+        if item['type'] != 'audio' or item['info'].get('is_live'):
+            await event.respond("❌ **Effects work on audio tracks only**")
+            return
+        
+        effect = None if effect == 'off' else effect
+        effect_path = status_msg = None
+        if effect:
+            status_msg = await event.respond(f"🎛️ **Applying {AUDIO_EFFECTS[effect][0]}...**")
+            try:
+                effect_path = await self.render_effect(item['info'], effect)
+            except Exception as e:
+                logger.error(f"Effect render error: {e}")
+                await status_msg.edit("❌ **Failed to apply effect**")
+                return
+        
+        reply = status_msg.edit if status_msg else event.respond
+        try:
+            applied = await self.apply_effect(chat_id, item, effect, effect_path)
+        except Exception as e:
+            logger.error(f"Effect switch error: {e}")
+            await reply("❌ **Failed to apply effect**")
+            return
+        if not applied:
+            await reply("❌ **That track is no longer in the queue**")
+            return
+        
+        label = AUDIO_EFFECTS[effect][0] if effect else "No effect"
+        await reply(f"🎛️ **{label}:** {item['info']['title']}")
+
+    @tracer.traced('effect.render')
+    async def render_effect(self, info, effect):
+        """Path of a track rendered with an effect, transcoded once and kept in the media cache"""
+        media_type = f"audio:{effect}"
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT file_path FROM media_cache WHERE track_id = ? AND media_type = ?', (info['track_id'], media_type))
+        row = cursor.fetchone()
+        if row and os.path.exists(row[0]):
+            return row[0]
+        
+        # Render from the full-quality source, not the tier variant this play was given
+        cursor.execute("SELECT file_path FROM media_cache WHERE track_id = ? AND media_type = 'audio'", (info['track_id'],))
+        row = cursor.fetchone()
+        source_path = row[0] if row and os.path.exists(row[0]) else None
+        
+        _, audio_filter, _ = AUDIO_EFFECTS[effect]
+        effect_path = str(self.media_store.cold_dir / f"{info['track_id']}.{effect}.opus")
+        await self.transcode(
+            self.media_store.resolve(source_path or info['file_path']), effect_path,
+            ['-vn', '-af', audio_filter, '-c:a', 'libopus', '-b:a', '160k']
+        )
+        if source_path or info.get('is_local'):
+            self.store_media_cache(dict(info, file_path=effect_path), media_type)
+        return effect_path
+
+    @chat_serialized
+    async def apply_effect(self, chat_id, item, effect, effect_path):
+        """Switch an item to a rendered effect, keeping the current track at the same point in the song"""
+        is_current = self.current_playing.get(chat_id) is item
+        if not is_current and not any(queued is item for queued in self.queue.get(chat_id, [])):
+            return False
+        
+        old_speed = self.effect_speed(item)
+        previous = item.get('effect'), item.get('effect_path')
+        item['effect'], item['effect_path'] = effect, effect_path
+        self.refresh_pins(chat_id)
+        if not is_current:
+            return True
+        
+        # Positions are in the rendered file's timeline
+        position = int(self.current_position(chat_id) * old_speed / self.effect_speed(item))
+        state = self.playback_positions.get(chat_id)
+        if state and state['started_at'] is None:
+            self.track_position(chat_id, position, paused=True)
+            return True
+        
+        try:
+            await self.call_py.change_stream(chat_id, await self.build_stream(item, position))
+        except Exception:
+            item['effect'], item['effect_path'] = previous
+            self.refresh_pins(chat_id)
+            raise
+        self.track_position(chat_id, position)
+        return True
 
+    @traced_command
     async def handle_volume(self, event):
         """Adjust volume"""
         message_parts = event.message.message.split()
@@ -565,6 +3351,7 @@ Join voice chat first, then use music commands!
         except Exception as e:
             await event.respond("❌ **Failed to change volume**")
 
+    @traced_command
     async def handle_current(self, event):
         """Show current playing song info"""
         chat_id = event.chat_id
@@ -575,9 +3362,14 @@ Join voice chat first, then use music commands!
         
         current = self.current_playing[chat_id]
         info = current['info']
-        media_icon = "🎥" if current['type'] == 'video' else "🎵"
+        media_icon = self.media_icon(current)
         
-        duration_formatted = f"{info['duration'] // 60}:{info['duration'] % 60:02d}" if info['duration'] else "Unknown"
+        if info.get('is_live'):
+            duration_formatted = "🔴 Live"
+        else:
+            duration_formatted = format_timestamp(self.effective_duration(current)) if info['duration'] else "Unknown"
+            if chat_id in self.playback_positions:
+                duration_formatted = f"{format_timestamp(self.current_position(chat_id))} / {duration_formatted}"
         
         current_msg = f"""
 {media_icon} **Currently Playing:**
@@ -589,8 +3381,86 @@ Join voice chat first, then use music commands!
 **📺 Uploader:** {info.get('uploader', 'Unknown')}
         """
         
-        await event.respond(current_msg)
+        try:
+            await self.send_card(event.chat_id, info, current_msg)
+        except Exception as e:
+            logger.warning(f"Now-playing card failed, sending text: {e}")
+            await event.respond(current_msg)
+
+    async def send_card(self, chat_id, info, caption):
+        """Send the track's card, reusing its uploaded photo when this process already sent it"""
+        key = (info['track_id'], CARD_TEMPLATE)
+        photo = self.card_refs.get(key)
+        if photo is not None:
+            try:
+                await self.app.send_file(chat_id, photo, caption=caption)
+                return
+            except Exception as e:
+                logger.info(f"Re-uploading card for {info['track_id']}: {e}")  # e.g. expired file reference
+                self.card_refs.pop(key, None)
+        
+        message = await self.app.send_file(chat_id, str(await self.now_playing_card(info)), caption=caption)
+        if getattr(message, 'photo', None):
+            if len(self.card_refs) >= self.max_cards:
+                self.card_refs.pop(next(iter(self.card_refs)))
+            self.card_refs[key] = message.photo
+
+    async def now_playing_card(self, info):
+        """Path of the track's rendered card, rendering it off the loop on first use"""
+        card_path = Path("cards") / f"{info['track_id']}-{CARD_TEMPLATE}.jpg"
+        if card_path.exists():
+            return card_path
+        
+        job = self.inflight_cards.get(card_path)
+        if job is None:
+            job = asyncio.ensure_future(self._render_card(info, card_path))
+            self.inflight_cards[card_path] = job
+            job.add_done_callback(lambda _: self.inflight_cards.pop(card_path, None))
+        await asyncio.shield(job)
+        return card_path
+
+    @tracer.traced('card.render')
+    async def _render_card(self, info, card_path):
+        thumbnail = await self.fetch_thumbnail(info.get('thumbnail'))
+        if info.get('is_live'):
+            footer = "LIVE"
+        else:
+            footer = format_timestamp(info['duration']) if info.get('duration') else ""
+        
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            self.card_executor, render_card,
+            thumbnail, info['title'], info.get('uploader') or '', footer, str(card_path)
+        )
+
+    async def fetch_thumbnail(self, url, max_bytes=5 * 1024 * 1024):
+        """Thumbnail bytes, or None if there is none or it can't be fetched"""
+        import aiohttp
+        
+        if not url or not url.startswith(('http://', 'https://')):
+            return None
+        try:
+            async with self.ranged_downloader.session.get(url, timeout=aiohttp.ClientTimeout(total=10)) as response:
+                if response.status != 200 or (response.content_length or 0) > max_bytes:
+                    return None
+                
+                data = bytearray()
+                async for chunk in response.content.iter_chunked(64 * 1024):
+                    data += chunk
+                    if len(data) > max_bytes:
+                        return None
+                return bytes(data)
+        except Exception as e:
+            logger.warning(f"Thumbnail fetch failed for {url}: {e}")
+            return None
+
+    def prune_cards(self):
+        """Blocking: keep only the most recently written cards on disk"""
+        cards = sorted(Path("cards").glob("*.jpg"), key=lambda path: path.stat().st_mtime, reverse=True)
+        for path in cards[self.max_cards:]:
+            path.unlink(missing_ok=True)
 
+    @traced_command
     async def handle_buy_premium(self, event):
         """Handle premium purchase"""
         user_id = event.sender_id
@@ -638,9 +3508,344 @@ Or use inline payment: /pay_premium
         
         await event.respond(premium_msg)
 
+    @traced_command
+    async def handle_stats(self, event):
+        """Handle /stats command (Admin only)"""
+        if event.sender_id not in self.admin_users:
+            await event.respond("❌ You're not authorized to use this command!")
+            return
+        
+        cursor = self.conn.cursor()
+        
+        # Get statistics
+        cursor.execute('SELECT COUNT(*) FROM users')
+        total_users = cursor.fetchone()[0]
+        
+        cursor.execute('SELECT COUNT(*) FROM users WHERE is_premium = TRUE')
+        premium_users = cursor.fetchone()[0]
+        
+        cursor.execute('SELECT COUNT(*) FROM banned_users')
+        banned_users = cursor.fetchone()[0]
+        
+        active_chats = len(self.current_playing)
+        total_queued = sum(len(queue) for queue in self.queue.values())
+        uptime = str(datetime.now() - self.started_at).split('.')[0]
+        
+        hot_rate, cold_rate = self.media_store.hit_rates()
+        store_stats = self.media_store.stats
+        
+        source_lines = ''.join(
+            f"\n  • {name}: {breaker.state.replace('_', '-')}, {breaker.stats['failed']} failed, {breaker.stats['fast_failed']} fast-failed"
+            for name, breaker in sorted(self.source_breakers.items())
+        )
+        
+        cold_hits, cold_misses = self.cache_lookups['cold_start_hits'], self.cache_lookups['cold_start_misses']
+        hits, misses = self.cache_lookups['hits'], self.cache_lookups['misses']
+        
+        quality_counts = Counter(self.governor.level(chat_id) for chat_id in self.governor.stream_paths)
+        
+        actors = list(self.chat_actors.values())
+        busiest = heapq.nlargest(3, actors, key=lambda actor: actor.busy_time)
+        busiest_lines = ''.join(
+            f"\n  • `{actor.chat_id}`: {actor.processed} cmds, avg {actor.busy_time / max(actor.processed, 1) * 1000:.0f}ms, "
+            f"max {actor.max_time * 1000:.0f}ms, depth {actor.depth} (peak {actor.max_depth})"
+            for actor in busiest
+        )
+        
+        stats_msg = f"""
+📊 **Bot Statistics**
+
+👥 **Users:** {total_users}
+💎 **Premium Users:** {premium_users}
+🚫 **Banned Users:** {banned_users}
+🎙️ **Active Voice Chats:** {active_chats}
+🎵 **Songs in Queue:** {total_queued}
+⏰ **Uptime:** {uptime}
+
+**💾 Media Cache:**
+🔥 **Hot tier hits:** {hot_rate:.0%}
+🗄️ **Cold tier hits:** {cold_rate:.0%}
+⬆️ **Promoted / demoted / evicted:** {store_stats['promoted']} / {store_stats['demoted']} / {store_stats['evicted']}
+⬇️ **Downloads running / waiting:** {sum(self.download_scheduler.active.values())} / {self.download_scheduler.pending}
+⚙️ **Extractors created:** {self.extractor_pool.created}
+🔌 **Sources:**{source_lines or ' none used yet'}
+
+**🌡️ Cache Warmer:**
+📥 **Warmed / already cached / failed:** {self.warm_stats['warmed']} / {self.warm_stats['already_cached']} / {self.warm_stats['failed']}
+⏸️ **Paused for live demand:** {self.warm_stats['paused']}
+🧊 **Cold-start hit rate:** {cold_hits / max(cold_hits + cold_misses, 1):.0%} of {cold_hits + cold_misses} requests
+🎯 **Overall hit rate:** {hits / max(hits + misses, 1):.0%} of {hits + misses} requests
+
+**🖥️ Stream Governor:**
+📈 **Host CPU:** {self.governor.host_cpu:.0f}%
+🎚️ **Streams high / medium / low:** {' / '.join(str(quality_counts[level]) for level in range(len(QUALITY_LEVELS)))}
+↕️ **Stepped down / up:** {self.governor.stats['stepped_down']} / {self.governor.stats['stepped_up']}
+⏳ **Joins held / timed out:** {self.governor.stats['join_waits']} / {self.governor.stats['join_timeouts']}
+
+**🧹 Idle Reaper:**
+💤 **Tracked chats:** {len(self.last_activity)}
+📤 **Chats released (idle / total):** {self.reaper_stats['idle_released']} / {self.reaper_stats['chats_released']}
+📞 **Calls left:** {self.reaper_stats['calls_left']}
+🗑️ **Queued items dropped:** {self.reaper_stats['queue_items_dropped']}
+
+**🎭 Chat Actors:**
+📬 **Live actors / queued commands:** {len(actors)} / {sum(actor.depth for actor in actors)}
+✅ **Commands processed:** {self.actor_totals['processed'] + sum(actor.processed for actor in actors)}
+🐢 **Busiest chats:**{busiest_lines or ' none'}
+        """
+        
+        await event.respond(stats_msg)
+
+    @traced_command
+    async def handle_profile(self, event):
+        """Profile the running bot for a bounded window (Admin only)"""
+        if event.sender_id not in self.admin_users:
+            await event.respond("❌ You're not authorized to use this command!")
+            return
+        
+        if self.profiling:
+            await event.respond("❌ **A profile is already running**")
+            return
+        
+        message_parts = event.message.message.split()
+        try:
+            seconds = int(message_parts[1]) if len(message_parts) > 1 else 30
+        except ValueError:
+            await event.respond(f"❌ **Usage:** `/profile [1-{self.profile_max_seconds} seconds]`")
+            return
+        seconds = max(1, min(seconds, self.profile_max_seconds))
+        
+        self.profiling = True
+        status_msg = await event.respond(f"🔬 **Profiling for {seconds}s...**")
+        
+        profiler = SamplingProfiler()
+        started_tracemalloc = not tracemalloc.is_tracing()
+        try:
+            if started_tracemalloc:
+                tracemalloc.start()
+            profiler.start()
+            await asyncio.sleep(seconds)
+            snapshot = tracemalloc.take_snapshot()
+        finally:
+            profiler.stop()
+            if started_tracemalloc:
+                tracemalloc.stop()
+            self.profiling = False
+        
+        report_path, summary = await asyncio.to_thread(self.write_profile_report, profiler, snapshot, seconds)
+        await status_msg.edit(f"{summary}\n📁 **Full profile:** `{report_path}`")
+
+    @traced_command
+    async def handle_trace(self, event):
+        """List recent traces or send one as a Chrome trace file (Admin only)"""
+        if event.sender_id not in self.admin_users:
+            await event.respond("❌ You're not authorized to use this command!")
+            return
+        
+        message_parts = event.message.message.split()
+        if len(message_parts) < 2:
+            if not tracer.recent:
+                await event.respond(f"🧭 **No traces yet** (sampling {tracer.sample_rate:.0%} of commands)")
+                return
+            lines = [
+                f"• `{trace_id}` {command} {duration:.0f}ms at {started.strftime('%H:%M:%S')}"
+                for trace_id, command, started, duration in reversed(tracer.recent)
+            ]
+            await event.respond("🧭 **Recent traces:**\n" + '\n'.join(lines[:20]) + "\n\nUse `/trace <id>` to fetch one")
+            return
+        
+        trace_id = message_parts[1]
+        events = await asyncio.to_thread(tracer.load, trace_id) if re.fullmatch(r'[0-9a-f]{16}', trace_id) else []
+        if not events:
+            await event.respond("❌ **Trace not found**")
+            return
+        
+        report_path = Path("profiles") / f"trace-{trace_id}.json"
+        report_path.write_text(json.dumps({'traceEvents': events, 'displayTimeUnit': 'ms'}))
+        
+        # Spans are logged when they end; order them by start and indent children under their parent
+        depth = {}
+        lines = []
+        for span in events:
+            depth[span['name']] = depth.get(span['args'].get('parent'), -1) + 1
+            lines.append(f"{'  ' * depth[span['name']]}{span['name']} {span['dur'] / 1000:.0f}ms")
+        summary = f"🧭 Trace {trace_id}\n" + '\n'.join(lines[:25])
+        await self.app.send_file(event.chat_id, str(report_path), caption=summary[:1000])
+
+    def write_profile_report(self, profiler, snapshot, seconds):
+        """Write the full profile to disk and build a chat-sized summary"""
+        snapshot = snapshot.filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ))
+        allocations = snapshot.statistics('lineno')
+        total_samples = max(sum(profiler.stacks.values()), 1)
+        
+        summary = f"🔬 **Profile ({seconds}s, {profiler.samples} samples)**\n\n**🔥 Hot functions:**\n"
+        for name, count in profiler.hot_functions():
+            summary += f"• `{name}` {count * 100 / total_samples:.1f}%\n"
+        
+        summary += "\n**🧠 Top allocations:**\n"
+        for stat in allocations[:5]:
+            frame = stat.traceback[0]
+            summary += f"• `{Path(frame.filename).name}:{frame.lineno}` {stat.size / 1024:.1f} KiB ({stat.count} blocks)\n"
+        
+        if self.loop_watchdog and self.loop_watchdog.stall_count:
+            summary += f"\n**🐢 Loop stalls:** {self.loop_watchdog.stall_count} (max lag {self.loop_watchdog.max_lag * 1000:.0f}ms)\n"
+        
+        report_path = Path("profiles") / f"profile-{datetime.now().strftime('%Y%m%d-%H%M%S')}.txt"
+        with open(report_path, 'w') as report:
+            report.write(f"# Sampling profile: {seconds}s, {profiler.samples} samples (collapsed stacks)\n")
+            report.write(profiler.collapsed())
+            report.write("\n\n# Top allocations\n")
+            for stat in allocations[:50]:
+                report.write(f"{stat}\n")
+            if self.loop_watchdog:
+                report.write("\n# Event loop blockers\n")
+                for stack, count in self.loop_watchdog.top_blockers(20):
+                    report.write(f"## seen {count} times\n{stack}\n")
+        
+        return report_path, summary
+
+    def history_page(self, chat_id, page):
+        """Rows of the chat's history page, most recent first"""
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT id, song_title, song_url, duration, played_at FROM song_history
+            WHERE chat_id = ?
+            ORDER BY id DESC
+            LIMIT ? OFFSET ?
+        ''', (chat_id, self.history_page_size, (page - 1) * self.history_page_size))
+        return cursor.fetchall()
+
+    def search_history(self, chat_id, query, limit=None):
+        """Most recent history rows in the chat whose title matches query"""
+        limit = limit or self.history_page_size
+        cursor = self.conn.cursor()
+        if self.history_fts:
+            tokens = re.findall(r'\w+', query.lower())
+            if not tokens:
+                return []
+            # The chat is part of the MATCH, so other chats' rows never reach the sort
+            terms = ' '.join(f'"{token}"' for token in tokens)
+            match = f'chat_id:"{abs(chat_id)}" AND song_title:({terms})'
+            cursor.execute('''
+                SELECT h.id, h.song_title, h.song_url, h.duration, h.played_at
+                FROM song_history_fts JOIN song_history h ON h.id = song_history_fts.rowid
+                WHERE song_history_fts MATCH ? AND h.chat_id = ?
+                ORDER BY song_history_fts.rowid DESC
+                LIMIT ?
+            ''', (match, chat_id, limit))
+        else:
+            cursor.execute('''
+                SELECT id, song_title, song_url, duration, played_at FROM song_history
+                WHERE chat_id = ? AND song_title LIKE ?
+                ORDER BY id DESC
+                LIMIT ?
+            ''', (chat_id, f'%{query}%', limit))
+        return cursor.fetchall()
+
+    @traced_command
+    async def handle_history(self, event):
+        """Show the chat's play history, paginated or filtered by a search"""
+        chat_id = event.chat_id
+        message_parts = event.message.message.split(' ', 1)
+        arg = message_parts[1].strip() if len(message_parts) > 1 else ''
+        
+        if arg and not arg.isdigit():
+            rows = self.search_history(chat_id, arg)
+            header = f"🔎 **History matching \"{arg}\":**\n\n"
+            footer = "Use `/replay <search>` to play the latest match again"
+            numbered = False
+        else:
+            page = max(1, int(arg or 1))
+            rows = self.history_page(chat_id, page)
+            header = f"📜 **Play History (page {page}):**\n\n"
+            footer = f"Use `/replay <n>` to play again • `/history {page + 1}` for older songs"
+            offset = (page - 1) * self.history_page_size
+            numbered = True
+        
+        if not rows:
+            await event.respond("📭 **No matching songs in this chat's history**")
+            return
+        
+        history_msg = header
+        for i, (_, title, _, duration, played_at) in enumerate(rows, 1):
+            prefix = f"{offset + i}." if numbered else "•"
+            length = format_timestamp(duration) if duration else "Live"
+            history_msg += f"{prefix} **{title}** ({length})\n   🕒 {played_at}\n"
+        
+        await event.respond(history_msg + "\n" + footer)
+
+    @traced_command
+    async def handle_replay(self, event):
+        """Queue a song from history through its stored URL and the media cache"""
+        if not await self.check_permissions(event):
+            return
+        
+        chat_id = event.chat_id
+        message_parts = event.message.message.split(' ', 1)
+        if len(message_parts) < 2 or not message_parts[1].strip():
+            await event.respond("❌ **Usage:** `/replay <n|search>`")
+            return
+        
+        arg = message_parts[1].strip()
+        if arg.isdigit():
+            cursor = self.conn.cursor()
+            cursor.execute('''
+                SELECT id, song_title, song_url, duration, played_at FROM song_history
+                WHERE chat_id = ?
+                ORDER BY id DESC
+                LIMIT 1 OFFSET ?
+            ''', (chat_id, max(0, int(arg) - 1)))
+            rows = cursor.fetchall()
+        else:
+            rows = self.search_history(chat_id, arg, limit=1)
+        
+        if not rows or not rows[0][2]:
+            await event.respond("❌ **No such song in this chat's history**")
+            return
+        
+        _, title, song_url, _, _ = rows[0]
+        is_premium = await self.is_premium_user(event.sender_id)
+        if not is_premium and len(self.queue.get(chat_id, [])) >= 10:
+            await event.respond("❌ **Queue limit reached!** Upgrade to premium for unlimited queue.")
+            return
+        
+        status_msg = await event.respond(f"🔁 **Replaying:** {title}")
+        try:
+            priority = self.download_priority(chat_id, is_premium)
+            media = await self.download_media(song_url, is_premium, media_type='audio', priority=priority)
+            if not media:
+                await status_msg.edit("❌ **That song is no longer available.**")
+                return
+            
+            await self.enqueue_track(event, status_msg, media, 'audio')
+        except MediaRejected as e:
+            await status_msg.edit(f"❌ **{e}**")
+        except Exception as e:
+            logger.error(f"Replay command error: {e}")
+            await status_msg.edit("❌ **Error processing your request. Please try again.**")
+
+    @tracer.traced('db.song_history')
     async def log_song_history(self, queue_item):
         """Log played song to history"""
         cursor = self.conn.cursor()
+        song_url = queue_item['info'].get('webpage_url') or ''
+        
+        # Extend the co-play graph with the edge from the chat's previous track
+        cursor.execute('''
+            SELECT song_url FROM song_history WHERE chat_id = ? ORDER BY id DESC LIMIT 1
+        ''', (queue_item['chat_id'],))
+        previous = cursor.fetchone()
+        if previous and previous[0] and song_url and previous[0] != song_url:
+            cursor.execute('''
+                INSERT INTO coplay_edges (src_url, dst_url, dst_title, weight, last_played)
+                VALUES (?, ?, ?, 1, CURRENT_TIMESTAMP)
+                ON CONFLICT (src_url, dst_url) DO UPDATE SET
+                    weight = weight + 1, dst_title = excluded.dst_title, last_played = excluded.last_played
+            ''', (previous[0], song_url, queue_item['info']['title']))
+        
         cursor.execute('''
             INSERT INTO song_history (chat_id, user_id, song_title, song_url, duration)
             VALUES (?, ?, ?, ?, ?)
@@ -660,22 +3865,196 @@ Or use inline payment: /pay_premium
         
         self.conn.commit()
 
+    async def drain(self):
+        """SIGTERM: stop taking new songs, let nearly finished tracks end, then checkpoint and exit"""
+        if self.draining:
+            return
+        self.draining = True
+        logger.info(f"Draining {len(self.current_playing)} active chat(s)")
+        
+        deadline = time.monotonic() + self.drain_grace
+        while time.monotonic() < deadline and any(self.ends_before(chat_id, deadline) for chat_id in list(self.current_playing)):
+            await asyncio.sleep(1)
+        
+        for chat_id in set(self.current_playing) | set(self.queue):
+            try:
+                await self.checkpoint_chat(chat_id)
+            except Exception as e:
+                logger.error(f"Error checkpointing chat {chat_id}: {e}")
+        
+        logger.info("Drain complete, handing over")
+        await self.app.disconnect()
+
+    def ends_before(self, chat_id, deadline):
+        """Whether the chat's current track finishes playing before deadline"""
+        info = self.current_playing[chat_id]['info']
+        state = self.playback_positions.get(chat_id)
+        if info.get('is_live') or not info.get('duration') or not state or state['started_at'] is None:
+            return False
+        remaining = self.effective_duration(self.current_playing[chat_id]) - self.current_position(chat_id)
+        return time.monotonic() + remaining <= deadline
+
+    @chat_serialized
+    async def checkpoint_chat(self, chat_id):
+        """Persist the chat's playback for the next instance and leave its call"""
+        current = self.current_playing.get(chat_id)
+        queue_items = self.queue.get(chat_id, [])
+        if not current and not queue_items:
+            return
+        
+        state = self.playback_positions.get(chat_id)
+        position = 0 if not current or current['info'].get('is_live') else self.current_position(chat_id)
+        await self.handover_store.save(
+            chat_id, json.dumps(current, default=str) if current else None, position,
+            bool(state and state['started_at'] is None), json.dumps(queue_items, default=str),
+            chat_id in self.autoplay_chats
+        )
+        
+        try:
+            await self.call_py.leave_group_call(chat_id)
+        except Exception:
+            pass
+
+    async def restore_checkpoints(self):
+        """Take over chats checkpointed by a draining instance, warming their media before rejoining"""
+        rows = await self.handover_store.take_all()
+        if not rows:
+            return 0
+        
+        restored = await asyncio.gather(*(self.restore_chat(*row) for row in rows), return_exceptions=True)
+        resumed = sum(1 for result in restored if result is True)
+        logger.info(f"Resumed {resumed} of {len(rows)} handed over chat(s)")
+        return resumed
+
+    async def restore_chat(self, chat_id, current_item, position, paused, queue_items, autoplay):
+        current = json.loads(current_item) if current_item else None
+        queue_items = json.loads(queue_items)
+        if autoplay:
+            self.autoplay_chats.add(chat_id)
+        
+        # The current and next-up files must be local before the call starts
+        if current:
+            current = await self.rehydrate(current)
+        if queue_items:
+            queue_items[0] = await self.rehydrate(queue_items[0])
+        queue_items = [item for item in queue_items if item]
+        return await self.resume_handover(chat_id, current, position, paused, queue_items)
+
+    @chat_serialized
+    async def resume_handover(self, chat_id, current, position, paused, queue_items):
+        if chat_id in self.current_playing or self.queue.get(chat_id):
+            logger.warning(f"Chat {chat_id} already active, dropping its handed over state")
+            return False
+        
+        self.queue[chat_id] = queue_items
+        self.queue_changed(chat_id)
+        self.touch_chat(chat_id)
+        if not current:
+            await self.play_next_in_queue(chat_id)
+            return chat_id in self.current_playing
+        
+        self.current_playing[chat_id] = current
+        self.refresh_pins(chat_id)
+        await self.media_store.settle()
+        self.track_position(chat_id, position, paused=bool(paused))
+        if paused:
+            return True  # /resume rejoins at the saved position
+        
+        if await self.rejoin_at_position(chat_id):
+            return True
+        await self.release_chat(chat_id)
+        return False
+
+    async def rehydrate(self, item):
+        """Re-fetch a handed over item whose cached file is not on this host"""
+        info = item['info']
+        if item.get('effect_path') and not os.path.exists(item['effect_path']):
+            item.pop('effect_path')
+            item.pop('effect', None)
+        if info.get('is_live') or os.path.exists(info['file_path']) or not info.get('webpage_url'):
+            return item
+        
+        try:
+            media = await self.download_media(
+                info['webpage_url'], await self.is_premium_user(item['user_id']),
+                media_type=item['type'], priority=PRIORITY_PLAYBACK
+            )
+        except MediaRejected:
+            media = None
+        if not media:
+            return None
+        item['info'] = media
+        return item
+
+    async def watch_handover(self):
+        """Pick up chats checkpointed by an old instance that drains after this one started"""
+        deadline = time.monotonic() + self.handover_window
+        while time.monotonic() < deadline:
+            await asyncio.sleep(2)
+            try:
+                await self.restore_checkpoints()
+            except Exception as e:
+                logger.error(f"Handover error: {e}")
+
+    def popular_tracks(self, limit):
+        """Most played URLs of recent history, plays weighted down by days since the last one"""
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT song_url, MAX(song_title)
+            FROM song_history
+            WHERE played_at >= datetime('now', ?) AND song_url LIKE 'http%' AND duration > 0
+            GROUP BY song_url
+            ORDER BY COUNT(*) / (1 + julianday('now') - julianday(MAX(played_at))) DESC
+            LIMIT ?
+        ''', (f'-{self.warm_history_days} days', limit))
+        return cursor.fetchall()
+
+    def live_demand(self):
+        """Whether downloads for users are running or waiting for a slot"""
+        scheduler = self.download_scheduler
+        return bool(scheduler.pending) or any(
+            count for priority, count in scheduler.active.items() if priority < PRIORITY_PREFETCH
+        )
+
+    async def warm_media_cache(self):
+        """Background task fetching the most played tracks while the cache is cold, yielding to live demand"""
+        for url, title in self.popular_tracks(self.warm_top_n):
+            if self.lookup_media_cache(url, 'audio'):
+                self.warm_stats['already_cached'] += 1
+                continue
+            
+            if self.live_demand():
+                self.warm_stats['paused'] += 1
+                while self.live_demand() and time.monotonic() < self.cold_start_until:
+                    await asyncio.sleep(5)
+            if self.draining or time.monotonic() >= self.cold_start_until:
+                logger.info(f"Cache warmer stopped after {self.warm_stats['warmed']} tracks")
+                return
+            
+            # Only the source: tier variants are derived when someone plays the track
+            try:
+                await self.resolve_source(url, url, 'audio', PRIORITY_PREFETCH)
+            except Exception as e:
+                logger.info(f"Cache warmer skipped {title}: {e}")
+                self.warm_stats['failed'] += 1
+                continue
+            
+            # Exact title searches resolve straight to the warmed file
+            self.store_search_cache(title, 'audio', url)
+            self.warm_stats['warmed'] += 1
+        
+        logger.info(f"Cache warmer done: {self.warm_stats['warmed']} fetched, {self.warm_stats['already_cached']} already cached")
+
     async def cleanup_old_files(self):
-        """Background task to cleanup old downloaded files"""
+        """Background task keeping the media cache within its size budget"""
         while True:
             try:
-                downloads_path = Path("downloads")
-                cutoff_time = datetime.now() - timedelta(hours=2)
-                
-                for file_path in downloads_path.glob("*"):
-                    if file_path.stat().st_mtime < cutoff_time.timestamp():
-                        file_path.unlink(missing_ok=True)
-                        logger.info(f"Cleaned up old file: {file_path}")
-                
+                await asyncio.to_thread(self.media_store.enforce_cold_budget)
+                await asyncio.to_thread(self.prune_cards)
             except Exception as e:
                 logger.error(f"Cleanup error: {e}")
             
-            await asyncio.sleep(3600)  # Run every hour
+            await asyncio.sleep(600)  # Run every 10 minutes
 
     async def update_premium_status(self):
         """Background task to update premium status"""
@@ -702,6 +4081,10 @@ Or use inline payment: /pay_premium
         """Check if user has permission to use the bot"""
         user_id = event.sender_id
         
+        if self.draining:
+            await event.respond("🔄 **Restarting for an update, try again in a few seconds**")
+            return False
+        
         # Check if banned
         cursor = self.conn.cursor()
         cursor.execute('SELECT reason FROM banned_users WHERE user_id = ?', (user_id,))
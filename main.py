@@ -1,3 +1,6 @@
+import time
+PROCESS_START = time.perf_counter()
+
 import os
 import asyncio
 import logging
@@ -7,13 +10,11 @@ from telethon.tl.functions.channels import GetFullChannelRequest
 from telethon.tl.functions.phone import CreateGroupCallRequest, JoinGroupCallRequest
 from telethon.tl.types import InputPeerChannel, InputGroupCall
 from telethon.errors import SessionPasswordNeededError
-import youtube_dl
 import sqlite3
 import json
 from typing import Dict, List
 import subprocess
 import tempfile
-import requests
 from io import BytesIO
 
 # Configure logging
@@ -87,7 +88,7 @@ class TelegramMusicBot:
     async def start(self):
         """Start the bot"""
         await self.client.start(bot_token=self.bot_token)
-        logger.info("Bot started successfully!")
+        logger.info(f"Bot started successfully! Ready in {time.perf_counter() - PROCESS_START:.2f}s")
         
         # Create downloads directory
         os.makedirs('downloads', exist_ok=True)
@@ -273,6 +274,8 @@ Contact admin for premium access!
 
     async def download_audio(self, query, is_premium=False):
         """Download audio from various sources"""
+        import youtube_dl  # heavy, imported on first use
+        
         ytdl_opts = self.ytdl_opts.copy()
         
         if is_premium:
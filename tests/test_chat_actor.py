@@ -0,0 +1,72 @@
+import asyncio
+
+from enhanced_bot import ChatActor
+
+
+def test_actor_survives_caller_cancelled_mid_command():
+    async def scenario():
+        actor = ChatActor(1)
+        started = asyncio.Event()
+
+        async def slow():
+            started.set()
+            await asyncio.sleep(0.05)
+            return 'slow'
+
+        async def quick():
+            return 'quick'
+
+        caller = asyncio.ensure_future(actor.submit(slow))
+        await started.wait()
+        caller.cancel()
+        queued = actor.submit(quick)
+
+        assert await asyncio.wait_for(queued, 1) == 'quick'
+        assert actor.task is None
+        assert actor.processed == 2
+
+    asyncio.run(scenario())
+
+
+def test_actor_survives_caller_cancelled_mid_failing_command():
+    async def scenario():
+        actor = ChatActor(1)
+        started = asyncio.Event()
+
+        async def failing():
+            started.set()
+            await asyncio.sleep(0.05)
+            raise RuntimeError('boom')
+
+        async def quick():
+            return 'quick'
+
+        caller = asyncio.ensure_future(actor.submit(failing))
+        await started.wait()
+        caller.cancel()
+
+        assert await asyncio.wait_for(actor.submit(quick), 1) == 'quick'
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_actor_cancels_queued_commands_and_restarts():
+    async def scenario():
+        actor = ChatActor(1)
+
+        async def slow():
+            await asyncio.sleep(10)
+
+        async def quick():
+            return 'quick'
+
+        running, queued = actor.submit(slow), actor.submit(quick)
+        await asyncio.sleep(0)
+        actor.task.cancel()
+        await asyncio.sleep(0.01)
+
+        assert running.cancelled() and queued.cancelled()
+        assert actor.task is None
+        assert await asyncio.wait_for(actor.submit(quick), 1) == 'quick'
+
+    asyncio.run(scenario())